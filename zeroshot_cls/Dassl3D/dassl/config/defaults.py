@@ -133,9 +133,27 @@ _C.MODEL.BACKBONE.NAME = ''
 _C.MODEL.BACKBONE.NAME2 = ''
 _C.MODEL.BACKBONE.PRETRAINED = True
 _C.MODEL.BACKBONE.CHANNEL = 512
+# Leave background patches of the depth maps out of ViT attention (inference only)
+_C.MODEL.BACKBONE.PRUNE_BACKGROUND = False
+_C.MODEL.BACKBONE.BACKGROUND_TOL = 1e-3
+# 'default' (nn.MultiheadAttention) or 'sdpa' (fused scaled-dot-product attention, inference only)
+_C.MODEL.BACKBONE.ATTENTION = 'default'
+# Fold BatchNorm and use channels_last in ResNet backbones (inference only)
+_C.MODEL.BACKBONE.OPTIMIZE = False
+# '' or 'dynamic' (INT8 MLP layers, needs USE_CUDA False)
+_C.MODEL.BACKBONE.QUANTIZE = ''
 # Projection
 _C.MODEL.PROJECT = CN()
 _C.MODEL.PROJECT.NUM_VIEWS = 10
+# Number of CPU threads used by the projection, 0 keeps the torch default
+_C.MODEL.PROJECT.NUM_THREADS = 0
+# Run the projection in the DataLoader worker processes
+_C.MODEL.PROJECT.IN_WORKERS = False
+# Custom view stages, each a list of NUM_VIEWS [[angles], [translation]] pairs,
+# the first stage gives the translation, empty keeps the built-in views
+_C.MODEL.PROJECT.VIEWS = []
+# Pool the weighted view features before matching a single [C, 512] text matrix
+_C.MODEL.PROJECT.POOLED = False
 # Adapter
 _C.MODEL.ADAPTER = CN()
 _C.MODEL.ADAPTER.RATIO = 0.6
@@ -220,6 +238,9 @@ _C.TEST.SPLIT = 'test'
 # Which model to test after training
 # Either last_step or best_val
 _C.TEST.FINAL_MODEL = 'last_step'
+# Dtype of the features saved by test_zs, '' keeps the
+# model dtype, 'fp16' or 'bf16' store them compactly
+_C.TEST.FEATURE_DTYPE = ''
 
 ###########################
 # Post search
@@ -228,6 +249,8 @@ _C.TEST.FINAL_MODEL = 'last_step'
 _C.SEARCH = CN()
 _C.SEARCH.TIME = 5
 _C.SEARCH.RANGE = 1
+# Number of view-weight candidates scored per batch
+_C.SEARCH.BATCH_SIZE = 256
 
 ###########################
 # Trainer specifics
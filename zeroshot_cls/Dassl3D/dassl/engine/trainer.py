@@ -12,7 +12,7 @@ from dassl.optim import build_optimizer, build_lr_scheduler
 from dassl.utils import (
     MetricMeter, AverageMeter, tolist_if_not, count_num_param, load_checkpoint,
     save_checkpoint, mkdir_if_missing, resume_from_checkpoint,
-    load_pretrained_weights
+    load_pretrained_weights, save_features
 )
 from dassl.modeling import build_head, build_backbone
 from dassl.evaluation import build_evaluator
@@ -392,7 +392,7 @@ class SimpleTrainer(TrainerBase):
         label_store = torch.cat(self.label_store)
         print('Save feature: ============================')
         print('Save labels: =============================')
-        torch.save(feat_store, osp.join(self.cfg.OUTPUT_DIR, "features.pt"))
+        save_features(feat_store, osp.join(self.cfg.OUTPUT_DIR, "features.pt"), self.cfg.TEST.FEATURE_DTYPE)
         torch.save(label_store, osp.join(self.cfg.OUTPUT_DIR, "labels.pt"))
         
         print('Total time: {}'.format(time.time() - start))
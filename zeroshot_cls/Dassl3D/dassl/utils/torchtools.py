@@ -15,9 +15,12 @@ from .tools import mkdir_if_missing
 __all__ = [
     'save_checkpoint', 'load_checkpoint', 'resume_from_checkpoint',
     'open_all_layers', 'open_specified_layers', 'count_num_param',
-    'load_pretrained_weights', 'init_network_weights'
+    'load_pretrained_weights', 'init_network_weights', 'save_features',
+    'load_features', 'round_trip_features'
 ]
 
+FEATURE_DTYPES = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
 
 def save_checkpoint(
     state,
@@ -258,6 +261,46 @@ def count_num_param(model):
     return sum(p.numel() for p in model.parameters())
 
 
+def save_features(features, fpath, dtype=''):
+    r"""Save features, optionally stored in a smaller dtype.
+
+    Args:
+        features (torch.Tensor): features to save.
+        fpath (str): path to save.
+        dtype (str, optional): '' keeps the dtype of features, 'fp16'
+            or 'bf16' stores them as such. load_features restores the
+            original dtype either way.
+    """
+    if dtype and dtype not in FEATURE_DTYPES:
+        raise ValueError('Unknown feature dtype "{}"'.format(dtype))
+    stored = features.to(FEATURE_DTYPES[dtype]) if dtype else features
+    torch.save(
+        {
+            'features': stored,
+            'dtype': str(features.dtype).split('.')[-1]
+        }, fpath
+    )
+
+
+def load_features(fpath, map_location=None):
+    r"""Load features saved by save_features, in their original dtype.
+
+    A plain tensor saved by torch.save is returned as is.
+    """
+    data = torch.load(fpath, map_location=map_location)
+    if torch.is_tensor(data):
+        return data
+    return data['features'].to(getattr(torch, data['dtype']))
+
+
+def round_trip_features(features, dtype=''):
+    r"""Features as load_features returns them after save_features
+    with dtype, without touching the disk."""
+    if not dtype:
+        return features
+    return features.to(FEATURE_DTYPES[dtype]).to(features.dtype)
+
+
 def load_pretrained_weights(model, weight_path):
     r"""Load pretrianed weights to model.
 
@@ -10,7 +10,8 @@ import datasets.modelnet40
 from trainers import best_param
 
 from trainers import zeroshot
-from trainers.post_search import search_weights_zs, search_prompt_zs
+from trainers.post_search import search_weights_zs, search_prompt_zs, check_feature_dtypes
+from trainers.export import export_and_compare
 
 def print_args(args, cfg):
     print('***************')
@@ -76,6 +77,22 @@ def setup_cfg(args):
     cfg.freeze()
     return cfg
 
+def check_quantization(cfg):
+    """CPU zero-shot accuracy of the FP32 and the dynamic INT8 backbone.
+    INT8 runs first, so the features.pt left behind are the FP32 ones.
+    """
+    accs = {}
+    for quantize in ['dynamic', '']:
+        q_cfg = cfg.clone()
+        q_cfg.defrost()
+        q_cfg.USE_CUDA = False
+        q_cfg.MODEL.BACKBONE.QUANTIZE = quantize
+        q_cfg.freeze()
+        accs[quantize] = build_trainer(q_cfg).test_zs()
+    print('=> FP32 accuracy: {:.2f}, INT8 accuracy: {:.2f} ({:+.2f})'.format(accs[''], accs['dynamic'], accs['dynamic'] - accs['']))
+    return accs
+
+
 def main(args):
     cfg = setup_cfg(args)
     
@@ -92,8 +109,18 @@ def main(args):
     print('Collecting env info ...')
     print('** System info **\n{}\n'.format(collect_env_info()))
 
+    # FP32 against dynamic INT8 on CPU, builds its own trainers
+    if args.check_quantization:
+        check_quantization(cfg)
+        return
+
     trainer = build_trainer(cfg)
 
+    # export the point cloud -> logits graph and check it against the trainer on CPU
+    if args.export:
+        export_and_compare(trainer, args.export)
+        return
+
     # zero-shot classification
     if args.zero_shot:
         trainer.test_zs()
@@ -101,6 +128,9 @@ def main(args):
     # view weight and prompt search
     vweights = best_param.best_prompt_weight['{}_{}_test_weights'.format(cfg.DATASET.NAME.lower(), cfg.MODEL.BACKBONE.NAME2)]
     prompts = best_param.best_prompt_weight['{}_{}_test_prompts'.format(cfg.DATASET.NAME.lower(), cfg.MODEL.BACKBONE.NAME2)]
+    if args.check_feature_dtypes:
+        check_feature_dtypes(cfg, vweights, prompts)
+        return
     if args.post_search:
         if args.zero_shot:
             prompts, image_feature = search_prompt_zs(cfg, vweights, searched_prompt=prompts)
@@ -123,6 +153,9 @@ if __name__ == '__main__':
     parser.add_argument('--model-dir', type=str, default='',help='load model from this directory for eval-only mode')
     parser.add_argument('--load-epoch', type=int, default=175, help='load model weights at this epoch for evaluation')
     parser.add_argument('--no-train', action='store_true', help='do not call trainer.train()')
+    parser.add_argument('--check-quantization', action='store_true', help='report the CPU zero-shot accuracy of the FP32 and the dynamic INT8 backbone')
+    parser.add_argument('--check-feature-dtypes', action='store_true', help='report the zero-shot accuracy of the saved features stored as fp16 and bf16')
+    parser.add_argument('--export', type=str, default='', help='export the point cloud -> logits graph to this .pt (TorchScript) or .onnx file')
     parser.add_argument('opts', default=None, nargs=argparse.REMAINDER, help='modify config options using the command-line')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,40 @@
+import os.path as osp
+import sys
+
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from trainers.mv_utils_zs import Grid2Image, Realistic_Projection, params, points2grid
+
+
+def test_depth_separable_matches_dense():
+    torch.manual_seed(0)
+    grid2image = Grid2Image()
+    assert grid2image.depth_separable
+
+    grid = torch.rand(2, params['depth'], params['resolution'], params['resolution'])
+    grid = grid * (grid > 0.9)
+    with torch.no_grad():
+        separable = grid2image(grid)
+        grid2image.depth_separable = False
+        dense = grid2image(grid)
+
+    assert separable.shape == dense.shape
+    assert torch.allclose(separable, dense, atol=1e-6)
+
+
+def test_view_bank_batch_one():
+    torch.manual_seed(0)
+    pc_views = Realistic_Projection(device='cpu')
+    view_bank = pc_views.view_bank
+    pc = torch.rand(1, 1024, 3)
+
+    points = view_bank(pc)
+    assert points.is_contiguous()
+    transform = view_bank.get('cpu')
+    for v in range(view_bank.num_views):
+        assert torch.allclose(points[v], pc[0] @ transform[v, :3] + transform[v, 3], atol=1e-6)
+
+    grid = points2grid(points)
+    assert grid.shape == (view_bank.num_views, params['depth'], params['resolution'], params['resolution'])
@@ -0,0 +1,24 @@
+import os.path as osp
+import sys
+
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from trainers.post_search import ColumnScorer
+
+
+def test_column_scorer_ties_match_argmax():
+    torch.manual_seed(0)
+    # small integer logits, so most rows have tied maxima
+    logits = torch.randint(0, 3, (256, 6)).float()
+    labels = torch.randint(0, 6, (256,))
+    scorer = ColumnScorer(logits, labels)
+
+    for c_i in range(logits.shape[1]):
+        cols = torch.randint(0, 3, (256, 4)).float()
+        counts = scorer.score(c_i, cols)
+        for j in range(cols.shape[1]):
+            replaced = logits.clone()
+            replaced[:, c_i] = cols[:, j]
+            assert counts[j].item() == (replaced.argmax(dim=-1) == labels).sum().item()
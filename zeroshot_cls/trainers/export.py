@@ -0,0 +1,125 @@
+import time
+import torch
+import torch.nn as nn
+
+from trainers.mv_utils_zs import params, points2grid
+
+
+class PointCLIPV2Graph(nn.Module):
+    """The point cloud -> logits path of a built PointCLIPV2_ZS trainer as one module, so that it
+    can be traced: view transform, projection, interpolation, visual encoder, view weighting and
+    the product with the precomputed text features.
+    Export from a trainer built with USE_CUDA False to get an fp32 artifact for CPU serving.
+    """
+    def __init__(self, trainer, imsize=224):
+        super().__init__()
+        pc_views = trainer.pc_views
+        self.num_views = trainer.num_views
+        self.channel = trainer.channel
+        self.pooled = trainer.pooled
+        self.imsize = imsize
+        self.dtype = trainer.dtype
+
+        self.register_buffer('transform', pc_views.view_bank.get(trainer.device, torch.float32))
+        self.grid2image = pc_views.grid2image
+        self.visual_encoder = trainer.visual_encoder
+        self.register_buffer('view_weights', trainer.view_weights.reshape(1, -1, 1))
+        self.register_buffer('text_feat', trainer.text_feat)
+
+    def forward(self, pc):
+        b, n, _ = pc.shape
+        points = torch.einsum('bnk,vkj->bvnj', pc, self.transform[:, :3]) + self.transform[None, :, None, 3]
+        points = points.reshape(b * self.num_views, n, 3)
+        grid = points2grid(points, resolution=params['resolution'], depth=params['depth'], exportable=True)
+        img = self.grid2image(grid)
+        img = torch.nn.functional.interpolate(img, size=(self.imsize, self.imsize), mode='bilinear', align_corners=True)
+
+        image_feat = self.visual_encoder(img.type(self.dtype))
+        image_feat = image_feat / image_feat.norm(dim=-1, keepdim=True)
+        image_feat_w = image_feat.reshape(-1, self.num_views, self.channel) * self.view_weights
+        if self.pooled:
+            image_feat_w = image_feat_w.sum(dim=1).type(self.dtype) / self.num_views ** 0.5
+        else:
+            image_feat_w = image_feat_w.reshape(-1, self.num_views * self.channel).type(self.dtype)
+        return 100. * image_feat_w @ self.text_feat.t()
+
+
+def export_graph(trainer, path, example_pc, fmt='torchscript', opset=18):
+    """Export the point cloud -> logits graph.
+    Args:
+        example_pc (torch.tensor): of size [B, num_points, 3], on the trainer device
+        fmt (str): 'torchscript' or 'onnx', the ONNX graph has a dynamic batch axis and needs opset 18 for the max-scatter
+    """
+    # tracing freezes the data-dependent number of kept patches, and quantized Linear layers are not exported
+    if getattr(trainer.visual_encoder, 'background_tol', None) is not None:
+        raise Exception("cannot export with MODEL.BACKBONE.PRUNE_BACKGROUND, build the trainer without it!")
+    if trainer.cfg.MODEL.BACKBONE.QUANTIZE:
+        raise Exception("cannot export a quantized backbone, build the trainer without MODEL.BACKBONE.QUANTIZE!")
+    graph = PointCLIPV2Graph(trainer).eval()
+    with torch.no_grad():
+        if fmt == 'torchscript':
+            torch.jit.trace(graph, example_pc).save(path)
+        elif fmt == 'onnx':
+            torch.onnx.export(graph, (example_pc,), path, input_names=['pc'], output_names=['logits'],
+                              dynamic_axes={'pc': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=opset)
+        else:
+            raise Exception("unknown export format!")
+    print('Exported {} graph to {}'.format(fmt, path))
+    return path
+
+
+def load_runtime(path):
+    """CPU runtime of an exported artifact, mapping a point cloud tensor to logits."""
+    if path.endswith('.onnx'):
+        import onnxruntime
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        return lambda pc: torch.from_numpy(session.run(None, {'pc': pc.cpu().numpy()})[0])
+    module = torch.jit.load(path, map_location='cpu').eval()
+    return lambda pc: module(pc.cpu())
+
+
+@torch.no_grad()
+def compare_runtime(trainer, path, data_loader, num_batches=10):
+    """Compare the exported artifact on CPU with PointCLIPV2_ZS.model_inference on the first batches.
+    Returns:
+        max_diff (float): largest absolute logit difference
+        agreement (float): fraction of equal predictions
+        latency (tuple): mean seconds per batch of the trainer and of the artifact
+    """
+    run = load_runtime(path)
+    num_stored = len(trainer.feat_store)
+    max_diff, agree, total = 0., 0, 0
+    ref_time, art_time = 0., 0.
+    for batch_idx, batch in enumerate(data_loader):
+        if batch_idx >= num_batches:
+            break
+        pc, label = trainer.parse_batch_test(batch)
+
+        start = time.time()
+        ref_logits = trainer.model_inference(pc, label).float().cpu()
+        ref_time += time.time() - start
+
+        start = time.time()
+        logits = run(pc).float()
+        art_time += time.time() - start
+
+        max_diff = max(max_diff, (logits - ref_logits).abs().max().item())
+        agree += (logits.argmax(dim=-1) == ref_logits.argmax(dim=-1)).sum().item()
+        total += pc.shape[0]
+    # model_inference stores features for post-search, which the comparison should not add to
+    del trainer.feat_store[num_stored:], trainer.label_store[num_stored:]
+
+    n = min(num_batches, batch_idx + 1)
+    print('Export check, max logit diff: {:.4f}, prediction agreement: {:.2f}%, latency: {:.1f} ms -> {:.1f} ms per batch'.format(
+        max_diff, 100. * agree / total, 1000. * ref_time / n, 1000. * art_time / n))
+    return max_diff, agree / total, (ref_time / n, art_time / n)
+
+
+def export_and_compare(trainer, path, num_batches=10):
+    fmt = 'onnx' if path.endswith('.onnx') else 'torchscript'
+    trainer.set_model_mode('eval')
+    example_pc, _ = trainer.parse_batch_test(next(iter(trainer.test_loader)))
+    if example_pc.dim() != 3:
+        raise Exception("export needs raw point clouds, disable MODEL.PROJECT.IN_WORKERS!")
+    export_graph(trainer, path, example_pc, fmt=fmt)
+    return compare_runtime(trainer, path, trainer.test_loader, num_batches=num_batches)
@@ -1,8 +1,12 @@
-from torch_scatter import scatter
 import torch.nn as nn
 import numpy as np
 import torch
 
+try:
+    from torch_scatter import scatter
+except ImportError:
+    scatter = None
+
 TRANS = -1.5
 
 # realistic projection parameters
@@ -31,11 +35,36 @@ class Grid2Image(nn.Module):
         kn3d = get3DGaussianKernel(params['convxy'], params['convz'], sigma=params['convsigmaxy'], zsigma=params['convsigmaz'])
         self.conv.weight.data = torch.Tensor(kn3d).repeat(1,1,1,1,1)
         self.conv.bias.data.fill_(0)
-            
+
+        # Without depth extent in the kernels, depth slices never mix before the
+        # final max, so each slice is processed by separable 2D max-pooling and
+        # Gaussian smoothing instead.
+        self.depth_separable = (params['maxpoolz'] == 1 and params['maxpoolpadz'] == 0 and
+                                params['convz'] == 1 and params['convpadz'] == 0)
+        if self.depth_separable:
+            pk, pp = params['maxpoolxy'], params['maxpoolpadxy']
+            self.maxpool_x = nn.MaxPool2d((1, pk), stride=1, padding=(0, pp))
+            self.maxpool_y = nn.MaxPool2d((pk, 1), stride=1, padding=(pp, 0))
+            ck, cp = params['convxy'], params['convpadxy']
+            kn1d = get1DGaussianKernel(ck, sigma=params['convsigmaxy'])
+            self.conv_x = nn.Conv2d(1, 1, kernel_size=(1, ck), stride=1, padding=(0, cp), bias=False)
+            self.conv_y = nn.Conv2d(1, 1, kernel_size=(ck, 1), stride=1, padding=(cp, 0), bias=False)
+            self.conv_x.weight.data = kn1d.view(1, 1, 1, ck).clone()
+            self.conv_y.weight.data = kn1d.view(1, 1, ck, 1).clone()
+
     def forward(self, x):
-        x = self.maxpool(x.unsqueeze(1))
-        x = self.conv(x)
-        img = torch.max(x, dim=2)[0]
+        if self.depth_separable:
+            b, d, h, w = x.shape
+            x = x.reshape(b * d, 1, h, w)
+            x = self.maxpool_y(self.maxpool_x(x))
+            x = self.conv_y(self.conv_x(x))
+            # the pooling padding does not keep the size, so take it from the output
+            h, w = x.shape[-2:]
+            img = torch.max(x.reshape(b, 1, d, h, w), dim=2)[0]
+        else:
+            x = self.maxpool(x.unsqueeze(1))
+            x = self.conv(x)
+            img = torch.max(x, dim=2)[0]
         img = img / torch.max(torch.max(img, dim=-1)[0], dim=-1)[0][:,:,None,None]
         img = 1 - img
         img = img.repeat(1,3,1,1)
@@ -93,10 +122,12 @@ def euler2mat(angle):
     return rot_mat
 
 
-def points2grid(points, resolution=params['resolution'], depth=params['depth']):
+def points2grid(points, resolution=params['resolution'], depth=params['depth'], out=None, exportable=False):
     """Quantize each point cloud to a 3D grid.
     Args:
         points (torch.tensor): of size [B, _, 3]
+        out (torch.tensor): optional buffer of size [B, depth * resolution * resolution] to render into
+        exportable (bool): use the built-in scatter_reduce, which TorchScript and ONNX can export, even if torch_scatter is installed
     Returns:
         grid (torch.tensor): of size [B * self.num_views, depth, resolution, resolution]
     """
@@ -124,9 +155,15 @@ def points2grid(points, resolution=params['resolution'], depth=params['depth']):
     _z = torch.clip(_z, 1, depth - 2)
 
     coordinates = z_int * resolution * resolution + _y * resolution + _x
-    grid = torch.ones([batch, depth, resolution, resolution], device=points.device).view(batch, -1) * params['bg_clr']
+    if out is None:
+        grid = torch.ones([batch, depth, resolution, resolution], device=points.device).view(batch, -1) * params['bg_clr']
+    else:
+        grid = out.fill_(params['bg_clr'])
     
-    grid = scatter(_z, coordinates.long(), dim=1, out=grid, reduce="max")
+    if scatter is not None and not exportable:
+        grid = scatter(_z, coordinates.long(), dim=1, out=grid, reduce="max")
+    else:
+        grid = grid.scatter_reduce_(1, coordinates.long(), _z, reduce="amax", include_self=True)
     grid = grid.reshape((batch, depth, resolution, resolution)).permute((0,1,3,2))
 
     return grid
@@ -135,7 +172,13 @@ def points2grid(points, resolution=params['resolution'], depth=params['depth']):
 class Realistic_Projection:
     """For creating images from PC based on the view information.
     """
-    def __init__(self):
+    def __init__(self, device='cuda' if torch.cuda.is_available() else 'cpu', num_threads=0, views=None):
+        """
+        Args:
+            device (str or torch.device): where the projection runs
+            num_threads (int): number of intra-op threads on CPU, 0 keeps the torch default
+            views (list): optional view stages replacing the default ones, see ViewBank
+        """
         _views = np.asarray([
             [[1 * np.pi / 4, 0, np.pi / 2], [-0.5, -0.5, TRANS]],
             [[3 * np.pi / 4, 0, np.pi / 2], [-0.5, -0.5, TRANS]],
@@ -163,48 +206,84 @@ class Realistic_Projection:
             [[0, np.pi / 15, 0], [-0.5, 0, TRANS]],
             ])
 
-        self.num_views = _views.shape[0]
-
-        angle = torch.tensor(_views[:, 0, :]).float().cuda()
-        self.rot_mat = euler2mat(angle).transpose(1, 2)
-        angle2 = torch.tensor(_views_bias[:, 0, :]).float().cuda()
-        self.rot_mat2 = euler2mat(angle2).transpose(1, 2)
+        if not views:
+            views = [_views, _views_bias]
+        self.view_bank = ViewBank(*views)
+        self.num_views = self.view_bank.num_views
+        self.device = torch.device(device)
+        if self.device.type == 'cpu' and num_threads > 0:
+            torch.set_num_threads(num_threads)
 
-        self.translation = torch.tensor(_views[:, 1, :]).float().cuda()
-        self.translation = self.translation.unsqueeze(1)
-
-        self.grid2image = Grid2Image().cuda()
+        self.grid2image = Grid2Image().to(self.device)
+        # grid buffer reused across calls of the same batch size
+        self.grid = None
 
     def get_img(self, points):
+        points = points.to(self.device)
         b, _, _ = points.shape
-        v = self.translation.shape[0]
+        v = self.num_views
 
-        _points = self.point_transform(
-            points=torch.repeat_interleave(points, v, dim=0),
-            rot_mat=self.rot_mat.repeat(b, 1, 1),
-            rot_mat2=self.rot_mat2.repeat(b, 1, 1),
-            translation=self.translation.repeat(b, 1, 1))
+        _points = self.view_bank(points)
 
-        grid = points2grid(points=_points, resolution=params['resolution'], depth=params['depth']).squeeze()
+        grid_size = (b * v, params['depth'] * params['resolution'] * params['resolution'])
+        if self.grid is None or self.grid.shape != grid_size:
+            self.grid = torch.empty(grid_size, device=self.device)
+        grid = points2grid(points=_points, resolution=params['resolution'], depth=params['depth'], out=self.grid).squeeze()
         img = self.grid2image(grid)
         return img
 
-    @staticmethod
-    def point_transform(points, rot_mat, rot_mat2, translation):
+
+class ViewBank:
+    """Fused rigid transforms of all views. Each view is a chain of rotations
+    followed by a translation, folded once into a single 3x4 matrix [R; -t]
+    and cached per (device, dtype).
+    """
+    def __init__(self, views, *views_bias):
+        """
+        Args:
+            views (array): of size [V, 2, 3], euler angles and translation of each view
+            views_bias (array): of size [V, 2, 3], euler angles applied after the view rotation, translations are ignored
+        """
+        views = np.asarray(views, dtype=np.float64)
+        self.num_views = views.shape[0]
+
+        rot_mat = euler2mat(torch.tensor(views[:, 0, :])).transpose(1, 2)
+        for bias in views_bias:
+            bias = np.asarray(bias, dtype=np.float64)
+            assert bias.shape[0] == self.num_views, 'every view stage needs one entry per view'
+            rot_mat = rot_mat @ euler2mat(torch.tensor(bias[:, 0, :])).transpose(1, 2)
+        translation = torch.tensor(views[:, 1, :])
+
+        # [V, 4, 3]: points @ transform[:, :3] + transform[:, 3]
+        self.transform = torch.cat([rot_mat, -translation[:, None, :]], dim=1)
+        self._cache = {}
+
+    def get(self, device, dtype=torch.float32):
+        key = (torch.device(device), dtype)
+        if key not in self._cache:
+            self._cache[key] = self.transform.to(device=key[0], dtype=dtype)
+        return self._cache[key]
+
+    def __call__(self, points):
         """
-        :param points: [batch, num_points, 3]
-        :param rot_mat: [batch, 3]
-        :param rot_mat2: [batch, 3]
-        :param translation: [batch, 1, 3]
-        :return:
+        Args:
+            points (torch.tensor): of size [B, num_points, 3]
+        Returns:
+            points (torch.tensor): of size [B * num_views, num_points, 3], view-major within each batch item
         """
-        rot_mat = rot_mat.to(points.device)
-        rot_mat2 = rot_mat2.to(points.device)
-        translation = translation.to(points.device)
-        points = torch.matmul(points, rot_mat)
-        points = torch.matmul(points, rot_mat2)
-        points = points - translation
-        return points
+        b, n, _ = points.shape
+        transform = self.get(points.device, points.dtype)
+        points = torch.einsum('bnk,vkj->bvnj', points, transform[:, :3]) + transform[None, :, None, 3]
+        # einsum may keep a [b, n, v, 3] memory layout, which a batch of one would only view
+        return points.contiguous().reshape(b * self.num_views, n, 3)
+
+def get1DGaussianKernel(ksize, sigma=0):
+    center = ksize // 2
+    xs = (np.arange(ksize, dtype=np.float32) - center)
+    kernel1d = np.exp(-(xs ** 2) / (2 * sigma ** 2))
+    kernel1d = torch.from_numpy(kernel1d)
+    kernel1d = kernel1d / kernel1d.sum()
+    return kernel1d
 
 def get2DGaussianKernel(ksize, sigma=0):
     center = ksize // 2
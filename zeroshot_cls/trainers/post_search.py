@@ -1,8 +1,10 @@
+import os
 import json
 import clip
 import torch
+import numpy as np
 import os.path as osp
-import scipy.io as sio
+from dassl.utils import load_features, round_trip_features
 
 class_names = {
     'ModelNet40': ['airplane', 'bathtub', 'bed', 'bench', 'bookshelf', 'bottle', 'bowl', 'car', 'chair', 'cone', 'cup', 'curtain', 'desk', 'door', 'dresser', 'flower_pot', 'glass_box', 'guitar', 'keyboard', 'lamp', 'laptop', 'mantel', 'monitor', 'night_stand', 'person', 'piano', 'plant', 'radio', 'range_hood', 'sink', 'sofa', 'stairs', 'stool', 'table', 'tent', 'toilet', 'tv_stand', 'vase', 'wardrobe', 'xbox'],
@@ -19,69 +21,191 @@ def textual_encoder(cfg, clip_model, searched_prompt=None):
     """Encoding prompts.
     """
     prompt = searched_prompt
-    prompt_token = torch.cat([clip.tokenize(p) for p in prompt]).cuda()
-    text_feat = clip_model.encode_text(prompt_token).repeat(1, cfg.MODEL.PROJECT.NUM_VIEWS)
+    text_feat = clip.encode_texts(clip_model, prompt).repeat(1, cfg.MODEL.PROJECT.NUM_VIEWS)
     return text_feat
 
 
-def encode_prompt_lib(clip_model, cfg, dataset=''):
+def prompt_lib_path(cfg, dataset=''):
+    return 'prompts/{}_{}_text_feat_lib'.format(dataset, cfg.MODEL.BACKBONE.NAME2)
+
+
+def write_json(path, data):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def encode_prompt_lib(clip_model, cfg, dataset='', shard_rows=65536, batch_size=256):
     """Encoding GPT-3 generated text to a feature library.
+    Features are stored as fp16 rows in .npy shards of at most shard_rows rows (a class larger
+    than that gets a shard of its own), with index.json mapping each class to its shard and row
+    range. Classes are marked done in the index as they are written, so an interrupted run
+    resumes with the first unfinished class.
     """
-    save_path = 'prompts/{}_{}_text_feat_lib.mat'.format(dataset, cfg.MODEL.BACKBONE.NAME2)
-    if osp.exists(save_path):
+    save_path = prompt_lib_path(cfg, dataset)
+    index_path = osp.join(save_path, 'index.json')
+    with open('prompts/{}_1000.json'.format(dataset)) as f:
+        gpt_sents = json.load(f)
+
+    # the layout follows from the sentence counts alone, so a resumed run finds the same one
+    classes, shards = {}, []
+    for key in gpt_sents.keys():
+        rows = len(gpt_sents[key])
+        if not shards or shards[-1] + rows > shard_rows:
+            shards.append(0)
+        classes[key] = {'shard': len(shards) - 1, 'start': shards[-1], 'stop': shards[-1] + rows}
+        shards[-1] += rows
+    dim = clip_model.text_projection.shape[1]
+    index = {'dim': dim, 'dtype': 'float16', 'shards': shards, 'classes': classes, 'done': []}
+
+    if osp.exists(index_path):
+        with open(index_path) as f:
+            old_index = json.load(f)
+        if all(old_index[k] == index[k] for k in ['dim', 'dtype', 'shards', 'classes']):
+            index['done'] = old_index['done']
+    # classes marked done in a shard file that is gone are encoded again
+    shard_path = lambda k: osp.join(save_path, 'shard_{}.npy'.format(k))
+    missing = [k for k in range(len(shards)) if not osp.exists(shard_path(k))]
+    lost = [key for key in index['done'] if classes[key]['shard'] in missing]
+    if lost:
+        print('Shards {} of the prompt library are missing, encoding their {} classes again.'.format(missing, len(lost)))
+        index['done'] = [key for key in index['done'] if key not in lost]
+    if len(index['done']) == len(classes):
         return
-    
+
     print('Encoding prompt...')
-    f = open('prompts/{}_1000.json'.format(dataset))
-    gpt_sents = json.load(f)
-    
-    text_feat_lib = {}
+    os.makedirs(save_path, exist_ok=True)
+    done_shards = set(classes[key]['shard'] for key in index['done'])
+    stores = [np.lib.format.open_memmap(shard_path(k), mode='r+' if k in done_shards else 'w+',
+                                        dtype=np.float16, shape=(rows, dim)) for k, rows in enumerate(shards)]
+    for k, rows in enumerate(shards):
+        if stores[k].shape != (rows, dim) or stores[k].dtype != np.float16:
+            raise Exception("{} does not match index.json, delete {} to encode the library again!".format(shard_path(k), save_path))
+    write_json(index_path, index)
+
     for key in gpt_sents.keys():
-        temp_list = []
-        for jj in range(len(gpt_sents[key])):
-            prompt_token = clip.tokenize(gpt_sents[key][jj]).cuda()
-            text_feat = clip_model.encode_text(prompt_token)
-            temp_list.append(text_feat)
-        text_feat_lib[key] = torch.cat(temp_list).cpu().numpy().squeeze()
-    sio.savemat(save_path, text_feat_lib)
+        if key in index['done']:
+            continue
+        entry = classes[key]
+        tokens = clip.tokenize(gpt_sents[key]).to(clip_model.text_projection.device)
+        text_feat = clip_model.encode_text_sorted(tokens, batch_size)
+        stores[entry['shard']][entry['start']:entry['stop']] = text_feat.half().cpu().numpy()
+        stores[entry['shard']].flush()
+        index['done'].append(key)
+        write_json(index_path, index)
     print('End encoding prompt.')
     return
 
 
-def random_textual_replace(cfg, prompt_feat=None, c_i=None, sent_feat=None):
-    """Replace a category prompt from the pre-extracted text feature library.
+class PromptLibrary:
+    """Read-only view of a library written by encode_prompt_lib. Shards are memory-mapped on
+    first access, so only the rows of the classes being searched are read.
     """
-    temp_prompt_feat = prompt_feat.clone()
-    temp_prompt_feat[c_i, :] = torch.Tensor(sent_feat).float().cuda().repeat(1, cfg.MODEL.PROJECT.NUM_VIEWS)
-    return temp_prompt_feat
-    
-    
+    def __init__(self, path):
+        self.path = path
+        with open(osp.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        self.shards = {}
+
+    def __getitem__(self, key):
+        entry = self.index['classes'][key]
+        if entry['shard'] not in self.shards:
+            self.shards[entry['shard']] = np.load(osp.join(self.path, 'shard_{}.npy'.format(entry['shard'])), mmap_mode='r')
+        return self.shards[entry['shard']][entry['start']:entry['stop']]
+
+    def keys(self):
+        return self.index['classes'].keys()
+
+
 def read_prompts(cfg, dataset='modelnet40'):
-    f = open('prompts/{}_1000.json'.format(dataset))
-    data = json.load(f)
-    txt_feat = sio.loadmat('prompts/{}_{}_text_feat_lib.mat'.format(dataset, cfg.MODEL.BACKBONE.NAME2))
+    with open('prompts/{}_1000.json'.format(dataset)) as f:
+        data = json.load(f)
+    txt_feat = PromptLibrary(prompt_lib_path(cfg, dataset))
     return data, txt_feat
 
 
+class ColumnScorer:
+    """Top-1 accuracy of a logit matrix under replacement of a single column.
+    Caches the best and runner-up logit of every sample, so scoring a batch
+    of candidate columns costs O(N) per candidate.
+    """
+    def __init__(self, logits, labels):
+        self.logits = logits.clone()
+        self.labels = labels.view(-1)
+        self.update()
+
+    def update(self):
+        # max returns the first of tied maxima, as argmax does, topk gives no order among ties
+        first_val, first_idx = self.logits.max(dim=-1)
+        second_val, second_idx = self.logits.scatter(1, first_idx[:, None], float('-inf')).max(dim=-1)
+        self.top_val = torch.stack([first_val, second_val], dim=-1)
+        self.top_idx = torch.stack([first_idx, second_idx], dim=-1)
+
+    def score(self, c_i, cols):
+        """Number of correct predictions with column c_i replaced by each of cols [N, J].
+        """
+        # best logit among the other columns
+        first_is_ci = self.top_idx[:, 0] == c_i
+        other_val = torch.where(first_is_ci, self.top_val[:, 1], self.top_val[:, 0])[:, None]
+        other_idx = torch.where(first_is_ci, self.top_idx[:, 1], self.top_idx[:, 0])[:, None]
+        # ties go to the lower index, as in argmax
+        wins = (cols > other_val) | ((cols == other_val) & (c_i < other_idx))
+        labels = self.labels[:, None]
+        correct = torch.where(wins, labels == c_i, labels == other_idx)
+        return correct.sum(dim=0)
+
+    def replace(self, c_i, col):
+        self.logits[:, c_i] = col
+        self.update()
+
+
+@torch.no_grad()
+def check_feature_dtypes(cfg, vweights, prompts):
+    """Zero-shot accuracy of the saved features read back after storing them as fp16 and as bf16,
+    against the features as they are saved now.
+    """
+    print("\n***** Accuracy of each feature dtype *****")
+    image_feat = load_features(osp.join(cfg.OUTPUT_DIR, "features.pt"))
+    labels = torch.load(osp.join(cfg.OUTPUT_DIR, "labels.pt"))
+
+    clip_model, _ = clip.load_shared(cfg.MODEL.BACKBONE.NAME)
+    clip_model.eval()
+    text_feat = textual_encoder(cfg, clip_model, searched_prompt=prompts)
+    text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
+    view_weights = torch.tensor(vweights).cuda().reshape(1, -1, 1)
+
+    base_acc = None
+    for dtype in ['', 'fp16', 'bf16']:
+        feat = round_trip_features(image_feat, dtype)
+        feat = feat.reshape(-1, cfg.MODEL.PROJECT.NUM_VIEWS, cfg.MODEL.BACKBONE.CHANNEL) * view_weights
+        feat = feat.reshape(-1, cfg.MODEL.PROJECT.NUM_VIEWS * cfg.MODEL.BACKBONE.CHANNEL).type(clip_model.dtype)
+        acc, _ = accuracy(clip_model.logit_scale.exp() * feat @ text_feat.t(), labels, topk=(1, 5))
+        acc = (acc / image_feat.shape[0]) * 100
+        if base_acc is None:
+            base_acc = acc
+            print(f"=> Saved as {image_feat.dtype}, zero-shot accuracy: {acc:.2f}")
+        else:
+            print(f"=> Saved as {dtype}, zero-shot accuracy: {acc:.2f} ({acc - base_acc:+.2f})")
+
+
 @torch.no_grad()
 def search_prompt_zs(cfg, vweights, image_feature=None, searched_prompt=None, prompt_lib=None):
     print("\n***** Searching for prompts *****")
     
     labels = torch.load(osp.join(cfg.OUTPUT_DIR, "labels.pt"))
 
-    clip_model, _ = clip.load(cfg.MODEL.BACKBONE.NAME)
+    clip_model, _ = clip.load_shared(cfg.MODEL.BACKBONE.NAME)
     clip_model.eval()
     all_classes = class_names[cfg.DATASET.NAME]
     text_feat = textual_encoder(cfg, clip_model, searched_prompt=searched_prompt)
     text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)  
     
-    # Encoding all GPT generated prompt.
-    file = 'prompts/{}_{}_text_feat_lib.mat'.format(cfg.DATASET.NAME.lower(), cfg.MODEL.BACKBONE.NAME2)
-    if not osp.exists(file):
-        encode_prompt_lib(clip_model, cfg, dataset=cfg.DATASET.NAME.lower())
+    # Encoding all GPT generated prompt, resuming an interrupted run.
+    encode_prompt_lib(clip_model, cfg, dataset=cfg.DATASET.NAME.lower())
     
     if image_feature is None:
-        image_feat = torch.load(osp.join(cfg.OUTPUT_DIR, "features.pt"))
+        image_feat = load_features(osp.join(cfg.OUTPUT_DIR, "features.pt"))
     else:
         image_feat = image_feature
     view_weights = torch.tensor(vweights).cuda()
@@ -98,24 +222,32 @@ def search_prompt_zs(cfg, vweights, image_feature=None, searched_prompt=None, pr
     print("During search:")
     gpt_sents, text_feat_lib = read_prompts(cfg, dataset=cfg.DATASET.NAME.lower())
     prompts = searched_prompt
-    text_feat_ori = text_feat.clone()
     best_acc = acc
+
+    # Replacing the prompt of one class only changes that class's logit column.
+    # Normalizing a view-repeated sentence feature gives s / (|s| * sqrt(V)) per
+    # view, so the new column is the view-pooled image feature times s / |s|.
+    num_views = cfg.MODEL.PROJECT.NUM_VIEWS
+    image_feat_p = image_feat_w.float().reshape(-1, num_views, cfg.MODEL.BACKBONE.CHANNEL).sum(dim=1) / num_views ** 0.5
+    scorer = ColumnScorer(image_feat_w.float() @ text_feat.float().t(), labels)
     for kk in range(0, 2):
-        for ii in range(len(all_classes)):  
-            for jj in range(len(gpt_sents[all_classes[ii]])):
-                
-                text_feat = random_textual_replace(cfg, prompt_feat=text_feat_ori, c_i=ii, sent_feat=text_feat_lib[all_classes[ii]][jj,:])
-                text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
-                
-                logits = clip_model.logit_scale.exp() * image_feat_w @ text_feat.t() * 1.0
-                acc, _ = accuracy(logits, labels, topk=(1, 5))
-                acc = (acc / image_feat.shape[0]) * 100
+        for ii in range(len(all_classes)):
+            sent_feat = torch.tensor(text_feat_lib[all_classes[ii]]).float().cuda()
+            sent_feat = sent_feat / sent_feat.norm(dim=-1, keepdim=True)
+            cols = image_feat_p @ sent_feat.t()
+            accs = (scorer.score(ii, cols).float() / image_feat.shape[0] * 100).cpu().tolist()
 
+            # Candidates of one class all replace the same row, so they are
+            # independent of which of them is currently the best
+            best_jj = None
+            for jj, acc in enumerate(accs):
                 if acc > best_acc:
                     prompts[ii] = gpt_sents[all_classes[ii]][jj]
-                    text_feat_ori[ii, :] = torch.Tensor(text_feat_lib[all_classes[ii]][jj]).cuda().repeat(1, cfg.MODEL.PROJECT.NUM_VIEWS)
                     print('New best accuracy: {:.2f}, i-th class: {}, j-th sentence: {}'.format(acc, ii, jj))
                     best_acc = acc
+                    best_jj = jj
+            if best_jj is not None:
+                scorer.replace(ii, cols[:, best_jj])
     print('\nThe best prompt is: ')
     print(prompts)
     
@@ -123,22 +255,49 @@ def search_prompt_zs(cfg, vweights, image_feature=None, searched_prompt=None, pr
     return prompts, image_feat
 
 
+def view_logits(cfg, image_feat, text_feat):
+    """Per-view logits [V, N, C] of the view-concatenated features.
+    Logits are linear in the view weights, so any weighting is a
+    contraction of this tensor over V.
+    """
+    num_views, channel = cfg.MODEL.PROJECT.NUM_VIEWS, cfg.MODEL.BACKBONE.CHANNEL
+    image_feat = image_feat.reshape(-1, num_views, channel).float()
+    text_feat = text_feat.reshape(-1, num_views, channel).float()
+    return torch.einsum('nvd,cvd->vnc', image_feat, text_feat)
+
+
+def score_view_weights(vlogits, labels, weights, chunk_size=256):
+    """Number of correct top-1 predictions for each weight vector.
+    Args:
+        vlogits (torch.tensor): of size [V, N, C], from view_logits
+        labels (torch.tensor): of size [N]
+        weights (torch.tensor): of size [M, V]
+    Returns:
+        correct (torch.tensor): of size [M], kept on the device of vlogits
+    """
+    weights = weights.to(vlogits.device, vlogits.dtype)
+    labels = labels.to(vlogits.device).view(1, -1)
+    correct = []
+    for w in torch.split(weights, chunk_size):
+        pred = torch.einsum('mv,vnc->mnc', w, vlogits).argmax(dim=-1)
+        correct.append((pred == labels).sum(dim=-1))
+    return torch.cat(correct)
+
+
 @torch.no_grad()
 def search_weights_zs(cfg, prompt, vweights, image_feature=None, ):
     print("\n***** Searching for view weights *****")
     if image_feature is None:
         print("\n***** Loading saved features *****")
-        image_feat = torch.load(osp.join(cfg.OUTPUT_DIR, "features.pt"))
+        image_feat = load_features(osp.join(cfg.OUTPUT_DIR, "features.pt"))
     else: 
         image_feat = image_feature
     labels = torch.load(osp.join(cfg.OUTPUT_DIR, "labels.pt"))
 
-    clip_model, _ = clip.load(cfg.MODEL.BACKBONE.NAME)
+    clip_model, _ = clip.load_shared(cfg.MODEL.BACKBONE.NAME)
     clip_model.eval()
     text_feat = textual_encoder(cfg, clip_model, searched_prompt=prompt)
     text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
-    
-    view_weights = torch.tensor(vweights).cuda()
 
     # # Before search
     logits = clip_model.logit_scale.exp() * image_feat @ text_feat.t() * 1.0
@@ -152,30 +311,26 @@ def search_weights_zs(cfg, prompt, vweights, image_feature=None, ):
     vw = vweights
     # Search_time can be modulated in the config for faster search
     search_time, search_range = cfg.SEARCH.TIME, cfg.SEARCH.RANGE
-    search_list = [(i + 1) * search_range / search_time  for i in range(search_time)]
-    for a in search_list:
-        for b in search_list:
-            for c in search_list:
-                for d in search_list:
-                    for e in search_list:
-                        for f in search_list:
-                            for g in search_list:
-                                # Reweight different views
-                                view_weights = torch.tensor([0.75, 0.75, 0.75, a, b, c, d, e, f, g]).cuda()
-                                image_feat_w = image_feat.reshape(-1, cfg.MODEL.PROJECT.NUM_VIEWS, cfg.MODEL.BACKBONE.CHANNEL) * view_weights.reshape(1, -1, 1)
-                                image_feat_w = image_feat_w.reshape(-1, cfg.MODEL.PROJECT.NUM_VIEWS * cfg.MODEL.BACKBONE.CHANNEL).type(clip_model.dtype)
-                                
-                                logits = clip_model.logit_scale.exp() * image_feat_w @ text_feat.t() * 1.0                                       
-                                acc, _ = accuracy(logits, labels, topk=(1, 5))
-                                acc = (acc / image_feat.shape[0]) * 100
-
-                                if acc > best_acc:
-                                    vw = [0.75, 0.75, 0.75, a, b, c, d, e, f, g]
-                                    print('New best accuracy: {:.2f}, view weights: {}'.format(acc, vw))
-                                    best_acc = acc
+    # float64 so the chosen weights read back as the same Python floats as in the nested loops
+    search_list = torch.tensor([(i + 1) * search_range / search_time  for i in range(search_time)], dtype=torch.float64)
 
-    print(f"=> After view weight search, zero-shot accuracy: {best_acc:.2f}")
-    return vw
+    # All candidates at once, in the same order as nested loops over a, b, ..., g
+    fixed = torch.tensor([0.75, 0.75, 0.75], dtype=torch.float64)
+    num_free = cfg.MODEL.PROJECT.NUM_VIEWS - fixed.shape[0]
+    free = torch.cartesian_prod(*[search_list] * num_free).reshape(-1, num_free)
+    candidates = torch.cat([fixed.expand(free.shape[0], -1), free], dim=1)
+
+    # Reweighting views only rescales per-view logits, so they are computed once
+    vlogits = view_logits(cfg, image_feat, text_feat)
+    correct = score_view_weights(vlogits, labels, candidates, cfg.SEARCH.BATCH_SIZE)
+    accs = (correct.float() / image_feat.shape[0] * 100).cpu().tolist()
 
+    for i, acc in enumerate(accs):
+        if acc > best_acc:
+            vw = candidates[i].tolist()
+            print('New best accuracy: {:.2f}, view weights: {}'.format(acc, vw))
+            best_acc = acc
 
+    print(f"=> After view weight search, zero-shot accuracy: {best_acc:.2f}")
+    return vw
 
@@ -1,10 +1,12 @@
 import torch
 from clip import clip
 import torch.nn as nn
+from torch.utils.data import get_worker_info
 
 from trainers.best_param import best_prompt_weight
 from trainers.mv_utils_zs import Realistic_Projection
 from dassl.engine import TRAINER_REGISTRY, TrainerX
+from dassl.data.data_manager import DataManager, DatasetWrapper
 
 class Textual_Encoder(nn.Module):
     def __init__(self, cfg, classnames, clip_model):
@@ -14,13 +16,41 @@ class Textual_Encoder(nn.Module):
         self.clip_model = clip_model
         self.dtype = clip_model.dtype
     
-    def forward(self):
+    def forward(self, pooled=False):
         prompts = best_prompt_weight['{}_{}_test_prompts'.format(self.cfg.DATASET.NAME.lower(), self.cfg.MODEL.BACKBONE.NAME2)]
-        prompts = torch.cat([clip.tokenize(p) for p in prompts]).cuda()
-        text_feat = self.clip_model.encode_text(prompts).repeat(1, self.cfg.MODEL.PROJECT.NUM_VIEWS)
+        text_feat = clip.encode_texts(self.clip_model, prompts)
+        if not pooled:
+            text_feat = text_feat.repeat(1, self.cfg.MODEL.PROJECT.NUM_VIEWS)
         return text_feat
 
 
+def project_pc(get_img, pc, imsize=224):
+    img = get_img(pc)
+    img = torch.nn.functional.interpolate(img, size=(imsize, imsize), mode='bilinear', align_corners=True)
+    return img
+
+
+class ProjectedDatasetWrapper(DatasetWrapper):
+    """Projects each point cloud to multi-view images inside the DataLoader
+    workers, so projection scales with DATALOADER.NUM_WORKERS and overlaps
+    with the visual encoder. 'img' becomes a tensor of size [num_views, 3, 224, 224].
+    """
+    def __init__(self, cfg, data_source, transform=None, is_train=False):
+        super().__init__(cfg, data_source, transform=transform, is_train=is_train)
+        self.pc_views = None
+
+    def __getitem__(self, idx):
+        output = super().__getitem__(idx)
+        if self.pc_views is None:
+            # created lazily, once per worker process; the thread count is only
+            # set inside workers, the main process keeps its own
+            num_threads = (self.cfg.MODEL.PROJECT.NUM_THREADS or 1) if get_worker_info() is not None else 0
+            self.pc_views = Realistic_Projection(device='cpu', num_threads=num_threads, views=self.cfg.MODEL.PROJECT.VIEWS)
+        with torch.no_grad():
+            output['img'] = project_pc(self.pc_views.get_img, torch.as_tensor(output['img'])[None])
+        return output
+
+
 def load_clip_to_cpu(cfg):
     backbone_name = cfg.MODEL.BACKBONE.NAME
     url = clip._MODELS[backbone_name]
@@ -34,25 +64,50 @@ def load_clip_to_cpu(cfg):
         state_dict = torch.load(model_path, map_location='cpu')
     
     model = clip.build_model(state_dict or model.state_dict())
+    if cfg.MODEL.BACKBONE.ATTENTION == 'sdpa':
+        clip.enable_sdpa(model)
     return model
 
 
 @TRAINER_REGISTRY.register()
 class PointCLIPV2_ZS(TrainerX):
 
+    def build_data_loader(self):
+        if not self.cfg.MODEL.PROJECT.IN_WORKERS:
+            return super().build_data_loader()
+        self.dm = DataManager(self.cfg, dataset_wrapper=ProjectedDatasetWrapper)
+        self.train_loader_x = self.dm.train_loader_x
+        self.train_loader_u = self.dm.train_loader_u
+        self.val_loader = self.dm.val_loader
+        self.test_loader = self.dm.test_loader
+        self.num_classes = self.dm.num_classes
+
     def build_model(self):
         cfg = self.cfg
         classnames = self.dm.dataset.classnames
 
         print(f'Loading CLIP (backbone: {cfg.MODEL.BACKBONE.NAME})')
         clip_model = load_clip_to_cpu(cfg)
-        clip_model.cuda()
+        clip_model.to(self.device)
+        if self.device.type == 'cpu':
+            # fp16 kernels are not available on CPU
+            clip_model.float()
+        if cfg.MODEL.BACKBONE.OPTIMIZE:
+            clip.optimize_for_inference(clip_model)
+        if cfg.MODEL.BACKBONE.QUANTIZE == 'dynamic':
+            if self.device.type != 'cpu':
+                raise Exception("dynamic quantization needs USE_CUDA False!")
+            clip.quantize_dynamic_int8(clip_model)
 
         # Encoders from CLIP
         self.visual_encoder = clip_model.visual
+        if cfg.MODEL.BACKBONE.PRUNE_BACKGROUND and hasattr(self.visual_encoder, 'background_tol'):
+            self.visual_encoder.background_tol = cfg.MODEL.BACKBONE.BACKGROUND_TOL
         textual_encoder = Textual_Encoder(cfg, classnames, clip_model)
         
-        text_feat = textual_encoder()
+        # pooled: a single [C, 512] text matrix, matched against the weighted sum of view features
+        self.pooled = cfg.MODEL.PROJECT.POOLED
+        text_feat = textual_encoder(pooled=self.pooled)
         self.text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
         
         self.logit_scale = clip_model.logit_scale
@@ -61,18 +116,22 @@ class PointCLIPV2_ZS(TrainerX):
     
         # Realistic projection
         self.num_views = cfg.MODEL.PROJECT.NUM_VIEWS
-        pc_views = Realistic_Projection()
+        pc_views = Realistic_Projection(device=self.device, num_threads=cfg.MODEL.PROJECT.NUM_THREADS, views=cfg.MODEL.PROJECT.VIEWS)
+        assert pc_views.num_views == self.num_views, 'MODEL.PROJECT.VIEWS must match MODEL.PROJECT.NUM_VIEWS'
+        self.pc_views = pc_views
         self.get_img = pc_views.get_img
 
         # Store features for post-search
         self.feat_store = []
         self.label_store = []
         
-        self.view_weights = torch.Tensor(best_prompt_weight['{}_{}_test_weights'.format(self.cfg.DATASET.NAME.lower(), self.cfg.MODEL.BACKBONE.NAME2)]).cuda()
+        self.view_weights = torch.Tensor(best_prompt_weight['{}_{}_test_weights'.format(self.cfg.DATASET.NAME.lower(), self.cfg.MODEL.BACKBONE.NAME2)]).to(self.device)
 
     def real_proj(self, pc, imsize=224):
-        img = self.get_img(pc).cuda()
-        img = torch.nn.functional.interpolate(img, size=(imsize, imsize), mode='bilinear', align_corners=True)        
+        if pc.dim() == 5:
+            # already projected in the DataLoader workers
+            return pc.reshape(-1, *pc.shape[2:]).to(self.device)
+        img = project_pc(self.get_img, pc, imsize).to(self.device)
         return img
     
     def model_inference(self, pc, label=None):
@@ -88,7 +147,11 @@ class PointCLIPV2_ZS(TrainerX):
             image_feat = image_feat / image_feat.norm(dim=-1, keepdim=True)
             
             image_feat_w = image_feat.reshape(-1, self.num_views, self.channel) * self.view_weights.reshape(1, -1, 1)
-            image_feat_w = image_feat_w.reshape(-1, self.num_views * self.channel).type(self.dtype)
+            if self.pooled:
+                # the replicated text feature is t / (|t| * sqrt(V)) in every view
+                image_feat_w = image_feat_w.sum(dim=1).type(self.dtype) / self.num_views ** 0.5
+            else:
+                image_feat_w = image_feat_w.reshape(-1, self.num_views * self.channel).type(self.dtype)
                         
             image_feat = image_feat.reshape(-1, self.num_views * self.channel)
 
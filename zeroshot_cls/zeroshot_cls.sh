@@ -17,3 +17,5 @@ python main.py \
 --no-train \
 --zero-shot \
 --post-search
+
+# CPU accuracy delta of dynamic INT8: append --check-quantization to the command above
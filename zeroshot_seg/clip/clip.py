@@ -1,15 +1,20 @@
 import os
+import time
+import json
 import hashlib
 import urllib
+import weakref
 import warnings
+from collections import OrderedDict
 from typing import Union, List
 
+import numpy as np
 import torch
 from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from tqdm import tqdm
 
-from .model import build_model
+from .model import build_model, enable_sdpa, optimize_for_inference, quantize_dynamic_int8
 from .simple_tokenizer import SimpleTokenizer as _Tokenizer
 
 try:
@@ -23,7 +28,7 @@ if torch.__version__.split(".") < ["1", "7", "1"]:
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
 
-__all__ = ["available_models", "load", "tokenize"]
+__all__ = ["available_models", "load", "load_shared", "convert_to_mmap", "load_mmap_state_dict", "evict", "loaded_models", "check_attention_parity", "check_inference_optimization", "tokenize", "TextFeatureCache", "encode_texts", "visual_fingerprint"]
 _tokenizer = _Tokenizer()
 
 _MODELS = {
@@ -36,6 +41,48 @@ _MODELS = {
 }
 
 
+def _sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _stamp_path(path: str) -> str:
+    return path + ".verified"
+
+
+def _file_state(path: str) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _write_stamp(path: str, sha256: str):
+    """Record that `path` matched `sha256` while it had its current size and mtime"""
+    try:
+        with open(_stamp_path(path), "w") as f:
+            json.dump({**_file_state(path), "sha256": sha256}, f)
+    except OSError:
+        pass  # a read-only cache only costs a re-hash next time
+
+
+def _is_verified(path: str, expected_sha256: str) -> bool:
+    """Whether `path` matches `expected_sha256`, trusting the stamp while the file is unchanged"""
+    try:
+        with open(_stamp_path(path)) as f:
+            stamp = json.load(f)
+        if stamp == {**_file_state(path), "sha256": expected_sha256}:
+            return True
+    except (OSError, ValueError):
+        pass
+
+    if _sha256(path) != expected_sha256:
+        return False
+    _write_stamp(path, expected_sha256)
+    return True
+
+
 def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
     os.makedirs(root, exist_ok=True)
     filename = os.path.basename(url)
@@ -47,11 +94,12 @@ def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        if hashlib.sha256(open(download_target, "rb").read()).hexdigest() == expected_sha256:
+        if _is_verified(download_target, expected_sha256):
             return download_target
         else:
             warnings.warn(f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file")
 
+    digest = hashlib.sha256()
     with urllib.request.urlopen(url) as source, open(download_target, "wb") as output:
         with tqdm(total=int(source.info().get("Content-Length")), ncols=80, unit='iB', unit_scale=True) as loop:
             while True:
@@ -60,10 +108,12 @@ def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
                     break
 
                 output.write(buffer)
+                digest.update(buffer)
                 loop.update(len(buffer))
 
-    if hashlib.sha256(open(download_target, "rb").read()).hexdigest() != expected_sha256:
+    if digest.hexdigest() != expected_sha256:
         raise RuntimeError(f"Model has been downloaded but the SHA256 checksum does not not match")
+    _write_stamp(download_target, expected_sha256)
 
     return download_target
 
@@ -83,7 +133,16 @@ def available_models() -> List[str]:
     return list(_MODELS.keys())
 
 
-def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit=False):
+def _model_path(name: str) -> str:
+    if name in _MODELS:
+        return _download(_MODELS[name])
+    elif os.path.isfile(name):
+        return name
+    else:
+        raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
+
+
+def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit=False, attention: str = "default", optimize: bool = False, quantize: str = None):
     """Load a CLIP model
 
     Parameters
@@ -97,6 +156,18 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     jit : bool
         Whether to load the optimized JIT model or more hackable non-JIT model (default).
 
+    attention : str
+        "default" keeps nn.MultiheadAttention, "sdpa" switches the non-JIT model to the inference-only
+        fused scaled-dot-product attention, see `clip.check_attention_parity`
+
+    optimize : bool
+        Fold BatchNorm into the convolutions of a non-JIT ResNet model and switch it to channels_last,
+        see `clip.check_inference_optimization`
+
+    quantize : str
+        "dynamic" applies dynamic INT8 quantization to the MLP Linear layers of the non-JIT model,
+        only supported on CPU
+
     Returns
     -------
     model : torch.nn.Module
@@ -105,12 +176,25 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     preprocess : Callable[[PIL.Image], torch.Tensor]
         A torchvision transform that converts a PIL image into a tensor that the returned model can take as its input
     """
-    if name in _MODELS:
-        model_path = _download(_MODELS[name])
-    elif os.path.isfile(name):
-        model_path = name
-    else:
-        raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
+    if attention not in ("default", "sdpa"):
+        raise RuntimeError(f"Unknown attention {attention}; use 'default' or 'sdpa'")
+    if quantize not in (None, "dynamic"):
+        raise RuntimeError(f"Unknown quantization {quantize}; use None or 'dynamic'")
+    if quantize and str(device) != "cpu":
+        raise RuntimeError("Quantized CLIP models only run on CPU")
+    model_path = _model_path(name)
+
+    if _is_mmap_weights(model_path):
+        model = build_model(load_mmap_state_dict(model_path), assign=True).to(device)
+        if str(device) == "cpu":
+            model.float()
+        if attention == "sdpa":
+            enable_sdpa(model)
+        if optimize:
+            optimize_for_inference(model)
+        if quantize:
+            quantize_dynamic_int8(model)
+        return model, _transform(model.visual.input_resolution)
 
     try:
         # loading JIT archive
@@ -127,8 +211,17 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
         model = build_model(state_dict or model.state_dict()).to(device)
         if str(device) == "cpu":
             model.float()
+        if attention == "sdpa":
+            enable_sdpa(model)
+        if optimize:
+            optimize_for_inference(model)
+        if quantize:
+            quantize_dynamic_int8(model)
         return model, _transform(model.visual.input_resolution)
 
+    if attention != "default" or optimize or quantize:
+        warnings.warn("attention, optimize and quantize are ignored for JIT models")
+
     # patch the device names
     device_holder = torch.jit.trace(lambda: torch.ones([]).to(torch.device(device)), example_inputs=[])
     device_node = [n for n in device_holder.graph.findAllNodes("prim::Constant") if "Device" in repr(n)][-1]
@@ -182,6 +275,191 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     return model, _transform(model.input_resolution.item())
 
 
+_MMAP_MAGIC = b"CLIPMMAP"
+_MMAP_ALIGN = 64
+
+
+def _is_mmap_weights(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(_MMAP_MAGIC)) == _MMAP_MAGIC
+
+
+def convert_to_mmap(name: str, path: str, dtype: torch.dtype = None):
+    """Write the weights of a CLIP model to a flat, memory-mappable file
+
+    The file holds a magic, the length of a JSON header, the header (name -> dtype, shape, offset)
+    and then every tensor of the `build_model` state dict at a 64-byte aligned offset. Passing the
+    resulting path to `clip.load` builds the model directly on the mapped pages.
+
+    Parameters
+    ----------
+    name : str
+        A model name listed by `clip.available_models()`, or the path to a model checkpoint
+
+    path : str
+        Where to write the converted weights
+
+    dtype : torch.dtype
+        Cast floating point weights before writing, e.g. torch.float32 for CPU workers, so that
+        `clip.load` does not need to make a converted copy
+    """
+    model_path = _model_path(name)
+    try:
+        state_dict = torch.jit.load(model_path, map_location="cpu").state_dict()
+    except RuntimeError:
+        state_dict = torch.load(model_path, map_location="cpu")
+    state_dict = build_model(state_dict).state_dict()
+    if dtype is not None:
+        state_dict = {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+
+    def align(offset):
+        return (offset + _MMAP_ALIGN - 1) // _MMAP_ALIGN * _MMAP_ALIGN
+
+    # offsets are relative to the data section, which starts at the first aligned byte after the header
+    header, offset = {}, 0
+    for key, tensor in state_dict.items():
+        header[key] = {"dtype": str(tensor.dtype).split(".")[-1], "shape": list(tensor.shape), "offset": offset}
+        offset = align(offset + tensor.numel() * tensor.element_size())
+    header_bytes = json.dumps(header).encode()
+    data_start = align(len(_MMAP_MAGIC) + 8 + len(header_bytes))
+
+    with open(path, "wb") as f:
+        f.write(_MMAP_MAGIC)
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for key, tensor in state_dict.items():
+            f.write(b"\0" * (data_start + header[key]["offset"] - f.tell()))
+            f.write(tensor.contiguous().numpy().tobytes())
+
+
+def load_mmap_state_dict(path: str) -> dict:
+    """Returns the state dict stored by `convert_to_mmap`, as CPU tensors viewing a private mapping of the file
+
+    Pages are only read on first use and stay shared with every other process mapping the same file.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(_MMAP_MAGIC)) != _MMAP_MAGIC:
+            raise RuntimeError(f"{path} is not a memory-mappable CLIP checkpoint")
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    data_start = (len(_MMAP_MAGIC) + 8 + header_len + _MMAP_ALIGN - 1) // _MMAP_ALIGN * _MMAP_ALIGN
+
+    data = torch.from_file(path, shared=False, size=os.path.getsize(path), dtype=torch.uint8)
+    state_dict = OrderedDict()
+    for key, entry in header.items():
+        dtype = getattr(torch, entry["dtype"])
+        numel = int(np.prod(entry["shape"], dtype=np.int64))
+        start = data_start + entry["offset"]
+        nbytes = numel * torch.empty([], dtype=dtype).element_size()
+        state_dict[key] = data[start:start + nbytes].view(dtype).view(entry["shape"])
+    return state_dict
+
+
+_shared_models = OrderedDict()
+
+
+def _registry_key(name: str, device: Union[str, torch.device], *options):
+    device = torch.device(device)
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return (name, str(device), *options)
+
+
+def load_shared(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", dtype: torch.dtype = None, jit=False, attention: str = "default", optimize: bool = False, quantize: str = None):
+    """Load a CLIP model once per process
+
+    Same as `clip.load`, but the model is built once per (name, device, dtype, jit, attention, optimize, quantize) and the
+    same eval-mode instance is handed out on every later call, so callers must not modify it in place.
+    `dtype` casts the non-JIT model, None keeps the default of `clip.load`.
+    """
+    key = _registry_key(name, device, dtype, jit, attention, optimize, quantize)
+    if key not in _shared_models:
+        model, preprocess = load(name, device=device, jit=jit, attention=attention, optimize=optimize, quantize=quantize)
+        if dtype is not None and not jit:
+            model = model.to(dtype)
+        _shared_models[key] = (model.eval(), preprocess)
+    return _shared_models[key]
+
+
+def evict(name: str = None, device: Union[str, torch.device] = None) -> int:
+    """Drop shared models matching `name` and `device` (None matches all), returns the number of models dropped"""
+    device = None if device is None else _registry_key("", device)[1]
+    keys = [key for key in _shared_models if (name is None or key[0] == name) and (device is None or key[1] == device)]
+    for key in keys:
+        del _shared_models[key]
+    if keys and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return len(keys)
+
+
+def _nbytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        # quantized Linear layers keep (weight, bias) packed together
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+def loaded_models() -> dict:
+    """Returns the bytes held by the parameters and buffers of each shared model, keyed by (name, device, dtype, jit, attention, optimize, quantize)"""
+    return {key: sum(_nbytes(v) for v in model.state_dict().values())
+            for key, (model, _) in _shared_models.items()}
+
+
+@torch.no_grad()
+def check_attention_parity(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", batch_size: int = 2):
+    """Returns the largest absolute difference of image and text features between the default and the sdpa attention"""
+    model, _ = load(name, device=device)
+    sdpa_model, _ = load(name, device=device, attention="sdpa")
+
+    resolution = model.visual.input_resolution
+    image = torch.randn(batch_size, 3, resolution, resolution, device=device)
+    text = tokenize(["a photo of a chair", "a depth map of an airplane"]).to(device)
+
+    def flat(features):
+        features = features if isinstance(features, tuple) else (features,)
+        return torch.cat([f.float().flatten() for f in features])
+
+    image_diff = (flat(model.encode_image(image)) - flat(sdpa_model.encode_image(image))).abs().max().item()
+    text_diff = (flat(model.encode_text(text)) - flat(sdpa_model.encode_text(text))).abs().max().item()
+    return {"image": image_diff, "text": text_diff}
+
+
+@torch.no_grad()
+def check_inference_optimization(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", batch_size: int = 10, repeats: int = 10):
+    """Compare `encode_image` of the original and the `optimize=True` model on random images
+
+    Returns the largest absolute difference of the image features and the mean seconds per batch of both
+    """
+    model, _ = load(name, device=device)
+    optimized_model, _ = load(name, device=device, optimize=True)
+
+    resolution = model.visual.input_resolution
+    image = torch.randn(batch_size, 3, resolution, resolution, device=device)
+
+    def flat(features):
+        features = features if isinstance(features, tuple) else (features,)
+        return torch.cat([f.float().flatten() for f in features])
+
+    def timed(m):
+        m.encode_image(image)  # warm-up
+        if torch.device(device).type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            features = m.encode_image(image)
+        if torch.device(device).type == "cuda":
+            torch.cuda.synchronize()
+        return features, (time.perf_counter() - start) / repeats
+
+    features, seconds = timed(model)
+    optimized_features, optimized_seconds = timed(optimized_model)
+    diff = (flat(features) - flat(optimized_features)).abs().max().item()
+    print(f"{name}: max abs diff {diff:.2e}, {seconds * 1000:.1f} ms -> {optimized_seconds * 1000:.1f} ms per batch of {batch_size}")
+    return {"diff": diff, "seconds": seconds, "optimized_seconds": optimized_seconds}
+
+
 def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False) -> torch.LongTensor:
     """
     Returns the tokenized representation of given input string(s)
@@ -206,16 +484,164 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
 
     sot_token = _tokenizer.encoder["<|startoftext|>"]
     eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
-    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+    all_tokens = _tokenizer.encode_batch(texts)
 
+    # filled row by row through numpy, so there is a single tensor allocation for the whole batch
+    result = np.zeros((len(all_tokens), context_length), dtype=np.int64)
     for i, tokens in enumerate(all_tokens):
-        if len(tokens) > context_length:
-            if truncate:
-                tokens = tokens[:context_length]
-                tokens[-1] = eot_token
-            else:
+        if len(tokens) + 2 > context_length:
+            if not truncate:
                 raise RuntimeError(f"Input {texts[i]} is too long for context length {context_length}")
-        result[i, :len(tokens)] = torch.tensor(tokens)
+            tokens = tokens[:context_length - 2]
+        result[i, 0] = sot_token
+        result[i, 1:len(tokens) + 1] = tokens
+        result[i, len(tokens) + 1] = eot_token
+
+    return torch.from_numpy(result)
+
+
+_fingerprints = weakref.WeakKeyDictionary()
+
+
+def _update_digest(digest, value):
+    if isinstance(value, torch.Tensor):
+        if value.is_quantized:
+            value = value.dequantize()
+        digest.update(value.detach().cpu().numpy().tobytes())
+    elif isinstance(value, (tuple, list)):
+        # quantized Linear layers keep (weight, bias) packed together
+        for v in value:
+            _update_digest(digest, v)
+    # anything else, e.g. the torch.dtype next to packed params, holds no weights
+
+
+def _fingerprint(model, visual: bool) -> str:
+    """sha256 over the weights of one tower, so features are only reused with the very same weights"""
+    fingerprints = _fingerprints.setdefault(model, {})
+    if visual not in fingerprints:
+        digest = hashlib.sha256(str(model.dtype).encode())
+        for name, param in sorted(model.state_dict().items()):
+            if name.startswith("visual.") != visual:
+                continue
+            digest.update(name.encode())
+            _update_digest(digest, param)
+        fingerprints[visual] = digest.hexdigest()[:16]
+    return fingerprints[visual]
+
+
+def _text_fingerprint(model) -> str:
+    return _fingerprint(model, visual=False)
+
+
+def visual_fingerprint(model) -> str:
+    """Fingerprint of the image tower weights, for keying caches of image features"""
+    return _fingerprint(model, visual=True)
+
+
+class TextFeatureCache:
+    """Content-addressed store of CLIP text embeddings
+
+    Each embedding is kept as an fp16 vector under the fingerprint of the text tower and the
+    normalized prompt, on disk below `root` and in an in-memory LRU of `capacity` entries.
+    """
+
+    def __init__(self, root: str = os.path.expanduser("~/.cache/clip/text_feat"), capacity: int = 4096):
+        self.root = root
+        self.capacity = capacity
+        self._lru = OrderedDict()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        # the tokenizer lowercases and collapses whitespace, so these prompts encode identically
+        return " ".join(text.split()).lower()
+
+    def _path(self, fingerprint: str, text: str) -> str:
+        name = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, fingerprint, name[:2], name + ".npy")
+
+    def get(self, fingerprint: str, text: str):
+        key = (fingerprint, text)
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            return self._lru[key]
+        path = self._path(fingerprint, text)
+        if not os.path.isfile(path):
+            return None
+        feat = torch.from_numpy(np.load(path))
+        self._remember(key, feat)
+        return feat
+
+    def put(self, fingerprint: str, text: str, feat: torch.Tensor):
+        feat = feat.detach().cpu().half()
+        path = self._path(fingerprint, text)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so concurrent jobs never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, feat.numpy())
+        os.replace(tmp_path, path)
+        self._remember((fingerprint, text), feat)
+        return feat
+
+    def _remember(self, key, feat):
+        self._lru[key] = feat
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+
+    def clear(self):
+        self._lru.clear()
+
+    @torch.no_grad()
+    def encode(self, model, texts: Union[str, List[str]], batch_size: int = 256) -> torch.Tensor:
+        """
+        Returns the text features of the given input string(s), encoding only the ones that are not cached
+
+        Parameters
+        ----------
+        model : torch.nn.Module
+            The CLIP model whose `encode_text` is used on a cache miss
+
+        texts : Union[str, List[str]]
+            An input string or a list of input strings to encode
+
+        batch_size : int
+            The number of missing strings encoded per `encode_text` call, sorted by length and trimmed to
+            the longest one when the model supports it
+
+        Returns
+        -------
+        A two-dimensional tensor of text features on the model device, shape = [number of input strings, embed_dim]
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        fingerprint = _text_fingerprint(model)
+        texts = [self.normalize(text) for text in texts]
+
+        feats = {}
+        for text in texts:
+            feat = self.get(fingerprint, text)
+            if feat is not None:
+                feats[text] = feat
+        missing = [text for text in dict.fromkeys(texts) if text not in feats]
+
+        device = model.text_projection.device
+        if missing:
+            tokens = tokenize(missing).to(device)
+            if hasattr(model, "encode_text_sorted"):
+                missing_feat = model.encode_text_sorted(tokens, batch_size)
+            else:
+                missing_feat = torch.cat([model.encode_text(tokens[i:i + batch_size]) for i in range(0, len(missing), batch_size)])
+            for text, feat in zip(missing, missing_feat):
+                feats[text] = self.put(fingerprint, text, feat)
+
+        # hits and misses both go through fp16, so results do not depend on the cache state
+        return torch.stack([feats[text] for text in texts]).to(device=device, dtype=model.dtype)
+
+
+_text_cache = TextFeatureCache()
+
 
-    return result
+def encode_texts(model, texts: Union[str, List[str]]) -> torch.Tensor:
+    """Encode the given input string(s) through the process-wide text feature cache"""
+    return _text_cache.encode(model, texts)
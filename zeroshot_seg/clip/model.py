@@ -1,4 +1,6 @@
+import inspect
 from collections import OrderedDict
+from contextlib import nullcontext
 from typing import Tuple, Union
 
 import numpy as np
@@ -7,6 +9,17 @@ import torch.nn.functional as F
 from torch import nn
 
 
+def fold_batch_norm(conv: nn.Conv2d, bn: nn.BatchNorm2d):
+    """Fold an eval-mode BatchNorm2d into the convolution in front of it, in place, computing in fp32"""
+    scale = bn.weight.float() * torch.rsqrt(bn.running_var.float() + bn.eps)
+    bias = bn.bias.float() - bn.running_mean.float() * scale
+    if conv.bias is not None:
+        bias = bias + conv.bias.float() * scale
+    with torch.no_grad():
+        conv.weight.copy_(conv.weight.float() * scale[:, None, None, None])
+    conv.bias = nn.Parameter(bias.to(conv.weight.dtype), requires_grad=False)
+
+
 class Bottleneck(nn.Module):
     expansion = 4
 
@@ -122,6 +135,8 @@ class ModifiedResNet(nn.Module):
         embed_dim = width * 32  # the ResNet feature dimension
         self.attnpool = AttentionPool2d(input_resolution // 32, embed_dim, heads, output_dim)
 
+        self.channels_last = False
+
     def _make_layer(self, planes, blocks, stride=1):
         layers = [Bottleneck(self._inplanes, planes, stride)]
 
@@ -131,6 +146,25 @@ class ModifiedResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def optimize_for_inference(self, channels_last=True):
+        """Fold every BatchNorm into its convolution and optionally switch to channels_last, inference only"""
+        pairs = [(self, "conv1", "bn1"), (self, "conv2", "bn2"), (self, "conv3", "bn3")]
+        for layer in [self.layer1, self.layer2, self.layer3, self.layer4]:
+            for block in layer:
+                pairs += [(block, "conv1", "bn1"), (block, "conv2", "bn2"), (block, "conv3", "bn3")]
+                if block.downsample is not None:
+                    pairs.append((block.downsample, "0", "1"))
+
+        for module, conv, bn in pairs:
+            if isinstance(getattr(module, bn), nn.BatchNorm2d):
+                fold_batch_norm(getattr(module, conv), getattr(module, bn))
+                setattr(module, bn, nn.Identity())
+
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        self.channels_last = channels_last
+        return self.eval()
+
     def forward(self, x):
         def stem(x):
             for conv, bn in [(self.conv1, self.bn1), (self.conv2, self.bn2), (self.conv3, self.bn3)]:
@@ -139,6 +173,8 @@ class ModifiedResNet(nn.Module):
             return x
 
         x = x.type(self.conv1.weight.dtype)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         x = stem(x)
         x1 = self.layer1(x)
         x2 = self.layer2(x1)
@@ -163,6 +199,29 @@ class QuickGELU(nn.Module):
         return x * torch.sigmoid(1.702 * x)
 
 
+class SDPAttention(nn.Module):
+    """Inference-only replacement of nn.MultiheadAttention on F.scaled_dot_product_attention
+
+    Takes over the fused in-projection and the out-projection of `attn` under the same names, so
+    state dicts stay compatible, and works on batch-first [N, L, D] input. The text tower's mask is
+    the causal one, which is passed as `is_causal` instead of being materialized.
+    """
+    def __init__(self, attn: nn.MultiheadAttention, causal: bool = False):
+        super().__init__()
+        self.num_heads = attn.num_heads
+        self.in_proj_weight = attn.in_proj_weight
+        self.in_proj_bias = attn.in_proj_bias
+        self.out_proj = attn.out_proj
+        self.causal = causal
+
+    def forward(self, x: torch.Tensor):
+        n, l, d = x.shape
+        qkv = F.linear(x, self.in_proj_weight, self.in_proj_bias)
+        q, k, v = qkv.view(n, l, 3, self.num_heads, d // self.num_heads).permute(2, 0, 3, 1, 4)
+        x = F.scaled_dot_product_attention(q, k, v, is_causal=self.causal)
+        return self.out_proj(x.transpose(1, 2).reshape(n, l, d))
+
+
 class ResidualAttentionBlock(nn.Module):
     def __init__(self, d_model: int, n_head: int, attn_mask: torch.Tensor = None):
         super().__init__()
@@ -178,8 +237,12 @@ class ResidualAttentionBlock(nn.Module):
         self.attn_mask = attn_mask
 
     def attention(self, x: torch.Tensor):
+        if isinstance(self.attn, SDPAttention):
+            return self.attn(x)
         self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
+        # text may be trimmed below the context length, see CLIP.encode_text_sorted
+        attn_mask = self.attn_mask[:x.shape[0], :x.shape[0]] if self.attn_mask is not None else None
+        return self.attn(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
 
     def forward(self, x: torch.Tensor):
         x = x + self.attention(self.ln_1(x))
@@ -193,10 +256,27 @@ class Transformer(nn.Module):
         self.width = width
         self.layers = layers
         self.resblocks = nn.Sequential(*[ResidualAttentionBlock(width, heads, attn_mask) for _ in range(layers)])
+        # the blocks take [L, N, D] input, or [N, L, D] once switched to SDPAttention
+        self.batch_first = False
 
     def forward(self, x: torch.Tensor):
         return self.resblocks(x)
 
+    def forward_batch_first(self, x: torch.Tensor):
+        """Run the blocks on [N, L, D] input, permuting only if they need it"""
+        if self.batch_first:
+            return self.resblocks(x)
+        x = x.permute(1, 0, 2)  # NLD -> LND
+        x = self.resblocks(x)
+        return x.permute(1, 0, 2)  # LND -> NLD
+
+    def use_sdpa(self):
+        for block in self.resblocks:
+            if not isinstance(block.attn, SDPAttention):
+                block.attn = SDPAttention(block.attn, causal=block.attn_mask is not None)
+        self.batch_first = True
+        return self
+
 
 class VisionTransformer(nn.Module):
     def __init__(self, input_resolution: int, patch_size: int, width: int, layers: int, heads: int, output_dim: int):
@@ -215,7 +295,37 @@ class VisionTransformer(nn.Module):
         self.ln_post = LayerNorm(width)
         self.proj = nn.Parameter(scale * torch.randn(width, output_dim))
 
-    def forward(self, x: torch.Tensor):
+        # inference only: if set, patches within this tolerance of the background are left out of attention
+        self.background_tol = None
+
+    def foreground_patches(self, image: torch.Tensor, background_tol: float):
+        """Patches that differ from the background, which is taken from the top-left pixel of each image"""
+        diff = (image - image[:, :, :1, :1]).abs().amax(dim=1, keepdim=True)
+        return F.max_pool2d(diff.float(), self.conv1.kernel_size).flatten(1) > background_tol
+
+    def pruned_transformer(self, x: torch.Tensor, fg: torch.Tensor):
+        """Run the transformer on the class token and the foreground patches only
+
+        Every image keeps as many patches as the one with most foreground, foreground first, so at
+        least one background patch stays in whenever any is pruned. Background patches only differ in
+        their positional embedding, so the pruned ones take the output of the first kept one.
+        """
+        n, l, d = x.shape
+        n_fg = fg.sum(dim=1)
+        keep = min(int(n_fg.max()) + 1, l - 1)
+        order = torch.sort((~fg).to(torch.uint8), dim=1, stable=True)[1] + 1
+        index = torch.cat([torch.zeros_like(order[:, :1]), order[:, :keep]], dim=1)[..., None].expand(-1, -1, d)
+
+        kept = torch.gather(x, 1, index)
+        kept = self.transformer.forward_batch_first(kept)
+
+        background = torch.gather(kept, 1, (1 + n_fg.clamp(max=keep - 1))[:, None, None].expand(-1, 1, d))
+        return background.expand(-1, l, -1).scatter(1, index, kept)
+
+    def forward(self, x: torch.Tensor, background_tol: float = None):
+        # a per-call tolerance leaves the attribute, and so every other holder of a shared model, untouched
+        background_tol = self.background_tol if background_tol is None else background_tol
+        fg = self.foreground_patches(x, background_tol) if background_tol is not None else None
         x = self.conv1(x)  # shape = [*, width, grid, grid]
         x = x.reshape(x.shape[0], x.shape[1], -1)  # shape = [*, width, grid ** 2]
         x = x.permute(0, 2, 1)  # shape = [*, grid ** 2, width]
@@ -224,9 +334,10 @@ class VisionTransformer(nn.Module):
         x = x + self.positional_embedding.to(x.dtype)
         x = self.ln_pre(x)
 
-        x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x)
-        x = x.permute(1, 0, 2)  # LND -> NLD
+        if fg is not None:
+            x = self.pruned_transformer(x, fg)
+        else:
+            x = self.transformer.forward_batch_first(x)
         x = self.ln_post(x)
 
         if self.proj is not None:
@@ -332,16 +443,17 @@ class CLIP(nn.Module):
     def dtype(self):
         return self.visual.conv1.weight.dtype
 
-    def encode_image(self, image):
-        return self.visual(image.type(self.dtype))
+    def encode_image(self, image, background_tol: float = None):
+        if background_tol is None:
+            return self.visual(image.type(self.dtype))
+        # ViT only, see VisionTransformer.background_tol
+        return self.visual(image.type(self.dtype), background_tol=background_tol)
 
     def encode_text(self, text):
         x = self.token_embedding(text).type(self.dtype)  # [batch_size, n_ctx, d_model]
 
-        x = x + self.positional_embedding.type(self.dtype)
-        x = x.permute(1, 0, 2)  # NLD -> LND
-        x = self.transformer(x)
-        x = x.permute(1, 0, 2)  # LND -> NLD
+        x = x + self.positional_embedding[:x.shape[1]].type(self.dtype)
+        x = self.transformer.forward_batch_first(x)
         x = self.ln_final(x).type(self.dtype)
 
         # x.shape = [batch_size, n_ctx, transformer.width]
@@ -350,6 +462,23 @@ class CLIP(nn.Module):
 
         return x
 
+    def encode_text_sorted(self, text, batch_size: int = 256):
+        """Same as encode_text, but every micro-batch is trimmed to its longest prompt
+
+        Prompts are sorted by length first, so micro-batches hold prompts of similar length. With the
+        causal mask, no position up to the EOT token attends to the padding, which makes trimming exact.
+        """
+        lengths = text.argmax(dim=-1) + 1
+        order = torch.argsort(lengths, descending=True)
+        x = None
+        for i in range(0, text.shape[0], batch_size):
+            index = order[i:i + batch_size]
+            feat = self.encode_text(text[index, :int(lengths[index].max())])
+            if x is None:
+                x = feat.new_empty(text.shape[0], feat.shape[-1])
+            x[index] = feat
+        return x
+
     def forward(self, image, text):
         image_features, feature_map = self.encode_image(image)
         text_features = self.encode_text(text)
@@ -391,7 +520,40 @@ def convert_weights(model: nn.Module):
     model.apply(_convert_weights_to_fp16)
 
 
-def build_model(state_dict: dict):
+def optimize_for_inference(model: nn.Module, channels_last: bool = True):
+    """Fold BatchNorm into the convolutions of a ModifiedResNet image tower and switch it to channels_last"""
+    if isinstance(model.visual, ModifiedResNet):
+        model.visual.optimize_for_inference(channels_last)
+    return model.eval()
+
+
+def quantize_dynamic_int8(model: nn.Module):
+    """Dynamic INT8 quantization of the MLP Linear layers of every transformer block, CPU inference only
+
+    The attention projections are left in float: nn.MultiheadAttention, SDPAttention and AttentionPool2d
+    read their projection weights directly instead of calling the Linear modules.
+    """
+    names = {f"{name}.mlp.{fc}" for name, module in model.named_modules()
+             if isinstance(module, ResidualAttentionBlock) for fc in ["c_fc", "c_proj"]}
+    return torch.quantization.quantize_dynamic(model.float(), names, dtype=torch.qint8, inplace=True).eval()
+
+
+def enable_sdpa(model: nn.Module):
+    """Switch every transformer of the model to SDPAttention (inference only)"""
+    for module in model.modules():
+        if isinstance(module, Transformer):
+            module.use_sdpa()
+    return model
+
+
+# load_state_dict(assign=True) came with torch 2.1
+_ASSIGN_SUPPORTED = "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def build_model(state_dict: dict, assign: bool = False):
+    """Build a CLIP model from its state dict. With `assign`, the model is built on the meta device and
+    takes the given tensors as its parameters without copying, keeping their device and dtype. On torch
+    older than 2.1 `assign` is ignored and the tensors are copied into a regularly built model."""
     
     # for k in state_dict.keys():
     #     print(k)
@@ -420,16 +582,28 @@ def build_model(state_dict: dict):
     transformer_heads = transformer_width // 64
     transformer_layers = len(set(k.split(".")[2] for k in state_dict if k.startswith(f"transformer.resblocks")))
 
-    model = CLIP(
-                embed_dim,
-                image_resolution, vision_layers, vision_width, vision_patch_size,
-                context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
-    )
+    assign = assign and _ASSIGN_SUPPORTED
+    meta = assign and hasattr(torch.device, "__enter__")
+    with torch.device("meta") if meta else nullcontext():
+        model = CLIP(
+                    embed_dim,
+                    image_resolution, vision_layers, vision_width, vision_patch_size,
+                    context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
+        )
 
     for key in ["input_resolution", "context_length", "vocab_size"]:
         if key in state_dict:
             del state_dict[key]
 
+    if assign:
+        model.load_state_dict(state_dict, assign=True)
+        if meta:
+            # the causal mask is a plain attribute, so it was left on the meta device
+            attn_mask = model.build_attention_mask()
+            for block in model.transformer.resblocks:
+                block.attn_mask = attn_mask
+        return model.eval()
+
     convert_weights(model)
     model.load_state_dict(state_dict)
     return model.eval()
@@ -1,6 +1,8 @@
 import gzip
 import html
 import os
+import pickle
+import hashlib
 from functools import lru_cache
 
 import ftfy
@@ -59,27 +61,80 @@ def whitespace_clean(text):
     return text
 
 
+def load_bpe_tables(bpe_path: str, cache_root: str = os.path.expanduser("~/.cache/clip")):
+    """Parse the BPE merges into (encoder, bpe_ranks), kept as a pickle next to the other CLIP downloads"""
+    stat = os.stat(bpe_path)
+    key = hashlib.sha1(f"{os.path.abspath(bpe_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_root, f"bpe_tables_{key}.pkl")
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            pass  # rebuilt below
+
+    merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
+    merges = merges[1:49152-256-2+1]
+    merges = [tuple(merge.split()) for merge in merges]
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v+'</w>' for v in vocab]
+    for merge in merges:
+        vocab.append(''.join(merge))
+    vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+    tables = dict(zip(vocab, range(len(vocab)))), dict(zip(merges, range(len(merges))))
+
+    try:
+        os.makedirs(cache_root, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass  # a read-only cache only costs parsing the merges again
+    return tables
+
+
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe()):
+    """BPE tokenizer of CLIP. The merge tables are loaded on first use, and BPE results of words and
+    token ids of whole texts are kept in LRU caches of `cache_size` entries."""
+
+    special_tokens = ('<|startoftext|>', '<|endoftext|>')
+
+    def __init__(self, bpe_path: str = default_bpe(), cache_size: int = 65536):
+        self.bpe_path = bpe_path
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
-        merges = merges[1:49152-256-2+1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v+'</w>' for v in vocab]
-        for merge in merges:
-            vocab.append(''.join(merge))
-        vocab.extend(['<|startoftext|>', '<|endoftext|>'])
-        self.encoder = dict(zip(vocab, range(len(vocab))))
-        self.decoder = {v: k for k, v in self.encoder.items()}
-        self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        self._encoder = None
+        self._decoder = None
+        self._bpe_ranks = None
         self.pat = re.compile(r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""", re.IGNORECASE)
-
-    def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
+        self.bpe = lru_cache(maxsize=cache_size)(self._bpe)
+        self._encode_cached = lru_cache(maxsize=cache_size)(self._encode)
+
+    def _load(self):
+        if self._encoder is None:
+            self._encoder, self._bpe_ranks = load_bpe_tables(self.bpe_path)
+            self._decoder = {v: k for k, v in self._encoder.items()}
+
+    @property
+    def encoder(self):
+        self._load()
+        return self._encoder
+
+    @property
+    def decoder(self):
+        self._load()
+        return self._decoder
+
+    @property
+    def bpe_ranks(self):
+        self._load()
+        return self._bpe_ranks
+
+    def _bpe(self, token):
+        if token in self.special_tokens:
+            return token
+        bpe_ranks = self.bpe_ranks
         word = tuple(token[:-1]) + ( token[-1] + '</w>',)
         pairs = get_pairs(word)
 
@@ -87,8 +142,8 @@ class SimpleTokenizer(object):
             return token+'</w>'
 
         while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
+            bigram = min(pairs, key = lambda pair: bpe_ranks.get(pair, float('inf')))
+            if bigram not in bpe_ranks:
                 break
             first, second = bigram
             new_word = []
@@ -115,16 +170,23 @@ class SimpleTokenizer(object):
             else:
                 pairs = get_pairs(word)
         word = ' '.join(word)
-        self.cache[token] = word
         return word
 
-    def encode(self, text):
+    def _encode(self, text):
         bpe_tokens = []
+        encoder = self.encoder
         text = whitespace_clean(basic_clean(text)).lower()
         for token in re.findall(self.pat, text):
             token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
-            bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
-        return bpe_tokens
+            bpe_tokens.extend(encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
+        return tuple(bpe_tokens)
+
+    def encode(self, text):
+        return list(self._encode_cached(text))
+
+    def encode_batch(self, texts):
+        """Token ids of each text, without the start and end tokens"""
+        return [self._encode_cached(text) for text in texts]
 
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
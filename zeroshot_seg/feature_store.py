@@ -0,0 +1,208 @@
+import os
+import json
+import torch
+import numpy as np
+
+CODECS = [None, 'fp16', 'bf16', 'bits', 'int16']
+
+
+def compact_codecs(feature_codec='fp16'):
+    """Storage codecs of extract_feature_maps outputs. The visibility is 0/1 and the point
+    locations are integers in [-23, 246] (pixels in [1, 222] shifted and scaled by the crop in
+    mv_proj, then ceiled), so only the feature codec can change results.
+    """
+    return {'features': feature_codec, 'ifseen': 'bits', 'pointloc': 'int16'}
+
+
+def encode(value, codec):
+    """Array of one object as stored on disk.
+    Args:
+        value (torch.tensor): any shape, for 'bits' of 0/1 values
+        codec (str): None keeps the dtype, 'fp16' and 'bf16' round the values, 'bits' packs
+            the last dim 8 values per byte and 'int16' takes integer values
+    """
+    if codec not in CODECS:
+        raise Exception("unknown codec!")
+    value = value.detach().cpu()
+    if codec == 'fp16':
+        return value.half().numpy()
+    if codec == 'bf16':
+        # numpy has no bfloat16, its bits are kept as int16
+        return value.to(torch.bfloat16).view(torch.int16).numpy()
+    if codec == 'bits':
+        return np.packbits(value.numpy().astype(bool), axis=-1)
+    if codec == 'int16':
+        assert torch.equal(value, value.round()) and value.abs().max() < 2 ** 15, 'int16 only holds integers in [-32768, 32767]'
+        return value.to(torch.int16).numpy()
+    return value.numpy()
+
+
+def decode(array, codec, size=None):
+    """Inverse of encode, returns the compact tensor: bf16 stays bfloat16 and bits become uint8.
+    Args:
+        array (np.ndarray): as stored
+        size (int): length of the last dim before packing, for 'bits'
+    """
+    if codec == 'bf16':
+        return torch.from_numpy(np.array(array)).view(torch.bfloat16)
+    if codec == 'bits':
+        return torch.from_numpy(np.unpackbits(array, axis=-1, count=size))
+    return torch.from_numpy(np.array(array))
+
+
+def round_trip(value, codec):
+    """value as it reads back after being stored with codec"""
+    return decode(encode(value, codec), codec, value.shape[-1]).to(value.device)
+
+
+def manifest_path(path, mode='test'):
+    return os.path.join(path, '{}_manifest.json'.format(mode))
+
+
+def shard_file(path, mode, name, k):
+    return os.path.join(path, '{}_{}_{:05d}.npy'.format(mode, name, k))
+
+
+def read_manifest(path, mode='test'):
+    if not os.path.exists(manifest_path(path, mode)):
+        return None
+    with open(manifest_path(path, mode)) as f:
+        return json.load(f)
+
+
+def first_missing_shard(path, mode, manifest):
+    """Index of the first shard of manifest with an array file missing, None if all are there."""
+    for k in range(len(manifest['shards'])):
+        if not all(os.path.exists(shard_file(path, mode, name, k)) for name in manifest['arrays']):
+            return k
+    return None
+
+
+def is_complete(path, mode='test'):
+    manifest = read_manifest(path, mode)
+    return manifest is not None and manifest['complete'] and first_missing_shard(path, mode, manifest) is None
+
+
+class FeatureShardWriter:
+    """Streams per-object arrays to disk in shards of shard_size objects.
+
+    Each array name gets one .npy file per shard, and {mode}_manifest.json lists the shards
+    written so far. It is rewritten after every shard, so a crashed extraction resumes
+    from num_written instead of starting over.
+    """
+    def __init__(self, path, mode='test', shard_size=64, codecs=None, resume=True):
+        """
+        Args:
+            path (str): directory of the shards
+            shard_size (int): objects per shard, an existing manifest keeps its own
+            codecs (dict): storage codec per array name, e.g. compact_codecs(), other arrays keep their dtype
+            resume (bool): append to the shards of an unfinished extraction instead of starting over
+        """
+        self.path = path
+        self.mode = mode
+        self.codecs = codecs or {}
+        manifest = read_manifest(path, mode) if resume else None
+        if manifest is None:
+            manifest = {'shard_size': shard_size, 'num': 0, 'shards': [], 'arrays': {}, 'complete': False}
+        k = first_missing_shard(path, mode, manifest)
+        if k is not None:
+            # shards are appended in order, so extraction restarts at the first one that is gone
+            print('Feature shard {} in {} is missing, extracting again from object {}.'.format(k, path, manifest['shards'][k]['start']))
+            manifest['num'] = manifest['shards'][k]['start']
+            manifest['shards'] = manifest['shards'][:k]
+            manifest['complete'] = False
+        self.manifest = manifest
+        self._buffer = {}
+
+    @property
+    def num_written(self):
+        return self.manifest['num']
+
+    def append(self, **arrays):
+        """Adds one object, each keyword is an array of that object, e.g. features=[V, C, H, W]."""
+        for name, value in arrays.items():
+            self._buffer.setdefault(name, []).append((value.shape, encode(value, self.codecs.get(name))))
+        if len(next(iter(self._buffer.values()))) == self.manifest['shard_size']:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        k = len(self.manifest['shards'])
+        size = len(next(iter(self._buffer.values())))
+        for name, values in self._buffer.items():
+            shape = values[0][0]
+            values = np.stack([value for _, value in values])
+            path = shard_file(self.path, self.mode, name, k)
+            np.save(path + '.tmp.npy', values)
+            os.replace(path + '.tmp.npy', path)
+            # shape is the decoded one of each object
+            self.manifest['arrays'][name] = {'codec': self.codecs.get(name), 'dtype': values.dtype.str, 'shape': list(shape)}
+        self.manifest['shards'].append({'start': self.num_written, 'stop': self.num_written + size})
+        self.manifest['num'] += size
+        self._buffer = {}
+        self._write_manifest()
+
+    def close(self):
+        self.flush()
+        self.manifest['complete'] = True
+        self._write_manifest()
+
+    def _write_manifest(self):
+        tmp = manifest_path(self.path, self.mode) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, manifest_path(self.path, self.mode))
+
+
+class FeatureShards:
+    """Reads the shards of a FeatureShardWriter, memory-mapped."""
+    def __init__(self, path, mode='test'):
+        self.path = path
+        self.mode = mode
+        self.manifest = read_manifest(path, mode)
+        if self.manifest is None:
+            raise Exception("no feature shards in {}!".format(path))
+        k = first_missing_shard(path, mode, self.manifest)
+        if k is not None:
+            raise Exception("feature shard {} in {} is missing, extract the features again with reuse=True!".format(k, path))
+
+    def __len__(self):
+        return self.manifest['num']
+
+    def shard(self, name, k):
+        """Array name of shard k as stored, a read-only np.memmap."""
+        return np.load(shard_file(self.path, self.mode, name, k), mmap_mode='r')
+
+    def decoded_shard(self, name, k):
+        array = self.manifest['arrays'][name]
+        return decode(self.shard(name, k), array['codec'], array['shape'][-1])
+
+    def iter_shards(self, names=None, device='cpu'):
+        """Yields dicts of decoded tensors of size [shard objects, ...], one shard at a time."""
+        names = names or list(self.manifest['arrays'])
+        for k in range(len(self.manifest['shards'])):
+            yield {name: self.decoded_shard(name, k).to(device) for name in names}
+
+    def load(self, name, device='cpu'):
+        """All objects of array name in one decoded tensor, filled shard by shard so only one copy is ever held."""
+        out = None
+        for k, shard in enumerate(self.manifest['shards']):
+            values = self.decoded_shard(name, k)
+            if out is None:
+                out = torch.empty([len(self)] + list(values.shape[1:]), dtype=values.dtype, device=device)
+            out[shard['start']:shard['stop']] = values
+        return out
+
+
+def load_features(path, mode='test', device='cuda'):
+    """Point clouds, feature maps, labels, visibility and point locations saved by extract_feature_maps,
+    from shards if there is a manifest, otherwise from the single .pt files of older runs.
+    Compactly stored arrays stay compact in memory: fp16/bf16 features, uint8 visibility and
+    int16 point locations, which run_epoch and point_view_feat take as they are.
+    """
+    names = ['pc', 'features', 'labels', 'ifseen', 'pointloc']
+    if read_manifest(path, mode) is None:
+        return [torch.load(os.path.join(path, '{}_{}.pt'.format(mode, name))).to(device) for name in names]
+    store = FeatureShards(path, mode)
+    return [store.load(name, device) for name in names]
@@ -63,7 +63,7 @@ class Extractor(torch.nn.Module):
 
 
 def eval_objs(model_name, partition, device, decorated=True, use_shapenetpart_tuned_prompt=False, visualize=False):
-    model, _ = clip.load(model_name, device=device)
+    model, _ = clip.load_shared(model_name, device=device)
     model.to(device)
 
     segmentor = Extractor(model)
@@ -82,10 +82,9 @@ def eval_objs(model_name, partition, device, decorated=True, use_shapenetpart_tu
         with torch.no_grad():
             is_seen, point_loc_in_img, feat = segmentor(pc)
             # encoding textual features
-            clip_model, _ = clip.load(model_name)
-            clip_model.eval()
-            prompts = torch.cat([clip.tokenize(p) for p in label_texts_ordered]).cuda()
-            text_feat = clip_model.encode_text(prompts)
+            clip_model = model
+            # batch_size is 1, so every label text comes collated as a 1-tuple
+            text_feat = clip.encode_texts(clip_model, [p[0] for p in label_texts_ordered])
             text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
             acc, iou, point_seg = eval_sample_objaverse(feat, label, is_seen, point_loc_in_img, text_feat, len(label_texts_ordered)-1)
             if visualize:
@@ -42,7 +42,7 @@ class Extractor(torch.nn.Module):
 
 
 def extract_feature_maps(model_name, data_path, class_choice, device, apply_rotation = False, subset=False, decorated=True):
-    model, _ = clip.load(model_name, device=device)
+    model, _ = clip.load_shared(model_name, device=device)
     model.to(device)
 
     segmentor = Extractor(model)
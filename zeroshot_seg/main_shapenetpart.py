@@ -1,40 +1,42 @@
 import os
+import json
 import torch
+import hashlib
 import random
 import warnings
 import argparse
 from tqdm import tqdm
 from clip import clip
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 warnings.filterwarnings("ignore")
 
 from best_param import *
 from data import ShapeNetPart, ShapeNetPartSmall
-from realistic_projection import Realistic_Projection
-from post_search import search_prompt, search_prompt_partm, search_vweight
+from realistic_projection import Realistic_Projection, MultiViewDataset, mv_proj, params, net
+from post_search import search_prompt, search_prompt_partm, search_vweight, check_storage_codecs
+from feature_store import FeatureShardWriter, compact_codecs, is_complete
 import time
 import numpy as np
 
 PC_NUM = 2048
 
 class Extractor(torch.nn.Module):
-    def __init__(self, model):
+    def __init__(self, model, renderer='dense', views=None, background_tol=None):
         super(Extractor, self).__init__()
 
         self.model = model
-        self.pc_views = Realistic_Projection()
+        # ViT only: leave background patches out of attention, passed per call since the model is shared
+        self.background_tol = background_tol if hasattr(model.visual, 'background_tol') else None
+        self.pc_views = Realistic_Projection(renderer=renderer, views=views)
         self.get_img = self.pc_views.get_img
         
     def mv_proj(self, pc):
-        img, is_seen, point_loc_in_img = self.get_img(pc)
-        img = img[:, :, 20:204, 20:204]
-        point_loc_in_img = torch.ceil((point_loc_in_img - 20) * 224. / 184.)
-        img = torch.nn.functional.interpolate(img, size=(224, 224), mode='bilinear', align_corners=True)
-        return img, is_seen, point_loc_in_img
-
-    def forward(self, pc):
-        img, is_seen, point_loc_in_img = self.mv_proj(pc)
-        _, x = self.model.encode_image(img)
+        return mv_proj(self.pc_views, pc)
+
+    def forward(self, pc, proj=None):
+        # proj: (img, is_seen, point_loc_in_img) when projected in the DataLoader workers
+        img, is_seen, point_loc_in_img = self.mv_proj(pc) if proj is None else proj
+        _, x = self.model.encode_image(img, background_tol=self.background_tol)
         x = x / x.norm(dim=-1, keepdim=True)
         
         B, L, C = x.shape
@@ -42,56 +44,80 @@ class Extractor(torch.nn.Module):
         return is_seen, point_loc_in_img, x
 
 
-def extract_feature_maps(model_name, data_path, class_choice, device, apply_rotation=False, subset=False):
-    model, _ = clip.load(model_name, device=device)
+def feature_key(test_set, segmentor, mode, renderer, background_tol, attention, codecs):
+    """Hash of everything the saved feature maps and labels depend on: the selected shapes (their
+    points, labels and rotations), the views, the projection params and the image tower weights. The prompts
+    play no part, so all prompt modes share one entry.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'mode': mode, 'class': test_set.class_choice, 'num_points': test_set.num_points,
+                              'apply_rotation': test_set.apply_rotation, 'params': params[net], 'renderer': renderer,
+                              'background_tol': background_tol, 'attention': attention,
+                              'codecs': codecs,
+                              'visual': clip.visual_fingerprint(segmentor.model)}, sort_keys=True).encode())
+    digest.update(np.ascontiguousarray(test_set.data[:, :test_set.num_points]).tobytes())
+    # labels are saved next to the features, so a changed annotation must not reuse them
+    digest.update(np.ascontiguousarray(test_set.label).tobytes())
+    digest.update(np.ascontiguousarray(test_set.seg[:, :test_set.num_points]).tobytes())
+    if test_set.apply_rotation:
+        digest.update(test_set.rotation.numpy().tobytes())
+    digest.update(segmentor.pc_views.view_bank.transform.numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def extract_feature_maps(model_name, data_path, class_choice, device, apply_rotation=False, subset=False, renderer='dense', num_workers=0, views=None, background_tol=None, attention='default', optimize=False, reuse=True, shard_size=64, compact=None):
+    """Extracts and saves feature maps, labels and point locations of one class.
+    Returns:
+        save_path (str): directory holding the features, named after their feature_key
+    """
+    model, _ = clip.load_shared(model_name, device=device, attention=attention, optimize=optimize)
     model.to(device)
 
-    segmentor = Extractor(model)
+    segmentor = Extractor(model, renderer=renderer, views=views, background_tol=background_tol)
     segmentor = segmentor.to(device)
     segmentor.eval()
     
     output_path = 'output/{}/'.format(model_name.replace('/', '_'))
     mode = 'test'
 
-    save_path = os.path.join(output_path, class_choice)
+    if subset:
+        test_set = ShapeNetPartSmall(data_path, apply_rotation=apply_rotation, partition=mode, num_points=PC_NUM, class_choice=class_choice)
+    else:
+        test_set = ShapeNetPart(data_path, apply_rotation=apply_rotation, partition=mode, num_points=PC_NUM, class_choice=class_choice)
+
+    # any change of the inputs gives a new key, so stale features are never read back
+    codecs = compact_codecs(compact) if compact else {}
+    save_path = os.path.join(output_path, class_choice, feature_key(test_set, segmentor, mode, renderer, background_tol, attention, codecs))
+    if reuse and is_complete(save_path, mode):
+        return save_path
     if not os.path.exists(save_path):
         os.makedirs(save_path)
-    if os.path.exists(os.path.join(save_path, "{}_features.pt".format(mode))):
-        pass#return so that when we run diff experiments we don't reuse features
+    # shards are written as extraction goes, an interrupted run picks up after the last full shard
+    writer = FeatureShardWriter(save_path, mode, shard_size=shard_size, codecs=codecs, resume=reuse)
+    test_set = Subset(test_set, range(writer.num_written, len(test_set)))
     
     #print('\nStart to extract and save feature maps of class {}...'.format(class_choice))
-    if subset:
-        test_loader = DataLoader(ShapeNetPartSmall(data_path, apply_rotation=apply_rotation, partition=mode, num_points=PC_NUM, class_choice=class_choice),batch_size=1, shuffle=False, drop_last=False)
-    else:
-        test_loader = DataLoader(ShapeNetPart(data_path, apply_rotation=apply_rotation, partition=mode, num_points=PC_NUM, class_choice=class_choice),batch_size=1, shuffle=False, drop_last=False)
-    feat_store, label_store, pc_store = [], [], []
-    ifseen_store, pointloc_store = [], []
+    if num_workers > 0:
+        # project in the worker processes, overlapping with the image encoder
+        test_set = MultiViewDataset(test_set, renderer=renderer, views=views)
+    test_loader = DataLoader(test_set, batch_size=1, shuffle=False, drop_last=False, num_workers=num_workers, pin_memory=num_workers > 0)
     for data in tqdm(test_loader):
         #eval shapenet-part
-        pc, label = data
-        pc, label = pc.cuda(), label.cuda()
+        pc, label = data[0].cuda(), data[1].cuda()
+        proj = None
+        if num_workers > 0:
+            img, is_seen, point_loc_in_img = data[2:]
+            proj = (img.reshape(-1, *img.shape[2:]).cuda(non_blocking=True),
+                    is_seen.reshape(-1, is_seen.shape[-1]).cuda(non_blocking=True),
+                    point_loc_in_img.reshape(-1, *point_loc_in_img.shape[2:]).cuda(non_blocking=True))
         with torch.no_grad():
-            is_seen, point_loc_in_img, feat = segmentor(pc)
-            pc_store.append(pc)
-            feat_store.append(feat[None,:,:,:])
-            label_store.append(label.squeeze()[None,:])
-            ifseen_store.append(is_seen[None,:,:])
-            pointloc_store.append(point_loc_in_img[None,:,:,:])
-
-    pc_store = torch.cat(pc_store, dim=0)
-    feat_store = torch.cat(feat_store, dim=0)
-    label_store = torch.cat(label_store, dim=0)
-    ifseen_store = torch.cat(ifseen_store, dim=0)
-    pointloc_store = torch.cat(pointloc_store, dim=0)
-    
-    # save features for post-search
-    print('Save feature: ============================')
-    print('Save labels: =============================')
-    torch.save(pc_store,  os.path.join(save_path, "{}_pc.pt".format(mode)))
-    torch.save(feat_store,  os.path.join(save_path, "{}_features.pt".format(mode)))
-    torch.save(label_store, os.path.join(save_path, "{}_labels.pt".format(mode)))
-    torch.save(ifseen_store,  os.path.join(save_path, "{}_ifseen.pt".format(mode)))
-    torch.save(pointloc_store, os.path.join(save_path, "{}_pointloc.pt".format(mode)))
+            is_seen, point_loc_in_img, feat = segmentor(pc, proj)
+            # features for post-search
+            writer.append(pc=pc[0], features=feat, labels=label.squeeze(), ifseen=is_seen, pointloc=point_loc_in_img)
+
+    # the manifest is only marked complete once every object is on disk
+    writer.close()
+    return save_path
 
 
 def main(args):
@@ -108,14 +134,17 @@ def main(args):
     for class_choice in classes:
 
         # extract and save feature maps, labels, point locations
-        extract_feature_maps(model_name, data_path, class_choice, device, args.apply_rotation, args.subset)
+        feature_path = extract_feature_maps(model_name, data_path, class_choice, device, args.apply_rotation, args.subset, args.renderer, args.num_workers, args.views, args.background_tol, args.attention, args.optimize, args.reuse_features, args.shard_size, args.compact_features)
+
+        if args.check_storage:
+            check_storage_codecs(class_choice, model_name, prompt_mode=args.prompt_mode, feature_path=feature_path)
 
         # test or post search prompt and view weights
-        iou = search_prompt(class_choice, model_name, prompt_mode=args.prompt_mode, only_evaluate=only_evaluate)
+        iou = search_prompt(class_choice, model_name, prompt_mode=args.prompt_mode, only_evaluate=only_evaluate, feature_path=feature_path)
         
         all_mious.append(iou)
         #if not only_evaluate:
-            #search_vweight(class_choice, model_name, prompts)
+            #search_vweight(class_choice, model_name, prompts, feature_path=feature_path)
     all_mean_iou = np.mean(all_mious)
     print(f"mean iou: {all_mean_iou}")
 
@@ -128,6 +157,16 @@ if __name__ == '__main__':
     args = parser.parse_args()
     args.apply_rotation = True
     args.subset = True
+    args.num_workers = 0 # > 0 runs the projection in DataLoader worker processes
+    args.views = None # list of view stages, each [[angles], [translation]] per view, None keeps the built-in 10 views
+    args.background_tol = None # e.g. 1e-3 leaves background patches out of ViT attention, faster but not exact
+    args.attention = "default" # sdpa runs CLIP attention on fused scaled-dot-product attention, see clip.check_attention_parity
+    args.optimize = False # folds BatchNorm and uses channels_last for RN50/RN101, see clip.check_inference_optimization
+    args.reuse_features = True # reuse features saved by an earlier run with the same data, views, projection and weights
+    args.shard_size = 64 # objects per feature shard, a crash loses at most one shard
+    args.compact_features = None # fp16 or bf16 stores features in that dtype, visibility bit-packed and point locations as int16, see post_search.check_storage_codecs
+    args.check_storage = False # prints the acc/IoU delta of storing features as fp16 and bf16
+    args.renderer = "dense" # dense renders through the full 3D grid, zbuffer through a 2D depth buffer with much less memory
     args.prompt_mode = "part" # tuned means the weird prompt tuned by pointclipv2, part means just querying with part name, decorated means querying with {part} of a {object}
     stime = time.time()
     main(args)
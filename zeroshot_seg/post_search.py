@@ -4,10 +4,12 @@ import torch
 import numpy as np
 import os.path as osp
 import scipy.io as sio
+from functools import lru_cache
 from best_param import *
 import torch.nn.functional as F
 from data import id2cat, cat2part
 from util import calculate_shape_IoU
+from feature_store import load_features, round_trip
 import open3d as o3d
 import plotly.graph_objects as go
 
@@ -95,8 +97,7 @@ def get_shapenetpart_tuned_prompt(clip_model, class_choice, searched_prompt=None
         sents = best_prompt[class_choice]
     else:
         sents = searched_prompt
-    prompts = torch.cat([clip.tokenize(p) for p in sents]).cuda()
-    text_feat = clip_model.encode_text(prompts)
+    text_feat = clip.encode_texts(clip_model, sents)
     return text_feat, sents
 
 def get_shapenetpart_generic_prompt(clip_model, class_choice, decorated = True):
@@ -105,8 +106,7 @@ def get_shapenetpart_generic_prompt(clip_model, class_choice, decorated = True):
         sents = [f"{part} of a {class_choice}" for part in parts]
     else:
         sents = parts
-    prompts = torch.cat([clip.tokenize(p) for p in sents]).cuda()
-    text_feat = clip_model.encode_text(prompts)
+    text_feat = clip.encode_texts(clip_model, sents)
     return text_feat, sents
 
 
@@ -119,41 +119,55 @@ def get_partnete_generic_prompt(clip_model, class_choice, decorated = True):
     else:
         sents = parts
     sents.append("other")
-    prompts = torch.cat([clip.tokenize(p) for p in sents]).cuda()
-    text_feat = clip_model.encode_text(prompts)
+    text_feat = clip.encode_texts(clip_model, sents)
     return text_feat, sents
 
 
+def get_shapenetpart_prompt(clip_model, class_choice, prompt_mode="tuned", searched_prompt=None):
+    if prompt_mode == "tuned":
+        return get_shapenetpart_tuned_prompt(clip_model, class_choice, searched_prompt)
+    elif prompt_mode == "decorated":
+        return get_shapenetpart_generic_prompt(clip_model, class_choice, decorated = True)
+    elif prompt_mode == "part":
+        return get_shapenetpart_generic_prompt(clip_model, class_choice, decorated = False)
+    else:
+        raise Exception("unknown prompt mode!")
+
+
+@lru_cache()
 def read_prompts():
-    f = open('prompts/shapenetpart_700.json')
-    data = json.load(f)
+    with open('prompts/shapenetpart_700.json') as f:
+        data = json.load(f)
     return data
 
+
+def encode_part_sentences(clip_model, class_choice, gpt_sents):
+    """Normalized text features of every GPT sentence of each part of a class, encoded in one batched pass.
+    Returns:
+        sent_feats (list): of size [num_parts], tensors of size [num_sentences, C]
+    """
+    parts = cat2part[class_choice]
+    sents = [sent for part in parts for sent in gpt_sents[class_choice][part]]
+    sent_feat = clip.encode_texts(clip_model, sents)
+    sent_feat = sent_feat / sent_feat.norm(dim=-1, keepdim=True)
+    return list(torch.split(sent_feat, [len(gpt_sents[class_choice][part]) for part in parts]))
+
 @torch.no_grad()
-def search_prompt(class_choice, model_name, prompt_mode="tuned", searched_prompt=None, only_evaluate=True):    
-    output_path = 'output/{}/{}'.format(model_name.replace('/', '_'), class_choice)
+def search_prompt(class_choice, model_name, prompt_mode="tuned", searched_prompt=None, only_evaluate=True, feature_path=None):    
+    # feature_path: directory returned by extract_feature_maps
+    output_path = feature_path or 'output/{}/{}'.format(model_name.replace('/', '_'), class_choice)
     
     # read saved feature maps, labels, point locations
     #print("\nReading saved feature maps of class {} ...".format(class_choice))
-    test_pc = torch.load(osp.join(output_path, "test_pc.pt")).cuda()
-    test_feat = torch.load(osp.join(output_path, "test_features.pt")).cuda()
-    test_label = torch.load(osp.join(output_path, "test_labels.pt")) - index_start[cat2id[class_choice]]
-    test_ifseen = torch.load(osp.join(output_path, "test_ifseen.pt"))
-    test_pointloc = torch.load(osp.join(output_path, "test_pointloc.pt"))
+    test_pc, test_feat, test_label, test_ifseen, test_pointloc = load_features(output_path)
+    test_label = test_label - index_start[cat2id[class_choice]]
     test_feat = test_feat.reshape(-1, 10, 196, 512)
 
     # encoding textual features
-    clip_model, _ = clip.load(model_name)
+    clip_model, _ = clip.load_shared(model_name)
     clip_model.eval()
     
-    if prompt_mode == "tuned":
-        text_feat, prompts = get_shapenetpart_tuned_prompt(clip_model, class_choice, searched_prompt)
-    elif prompt_mode == "decorated":
-        text_feat, prompts = get_shapenetpart_generic_prompt(clip_model, class_choice, decorated = True)
-    elif prompt_mode == "part":
-        text_feat, prompts = get_shapenetpart_generic_prompt(clip_model, class_choice, decorated = False)
-    else:
-        raise Exception("unknown prompt mode!")
+    text_feat, prompts = get_shapenetpart_prompt(clip_model, class_choice, prompt_mode, searched_prompt)
     text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
     
     vweights = torch.Tensor(best_vweight[class_choice]).cuda()
@@ -165,8 +179,13 @@ def search_prompt(class_choice, model_name, prompt_mode="tuned", searched_prompt
         return iou
     
     print("\n***** Searching for prompts *****\n")
-    print('\nBefore prompt search, Acc: {}, IoU: {}.\n'.format(acc, iou))    
     gpt_sents = read_prompts()
+    point_feat = precompute_point_feat(vweights, test_feat, test_ifseen, test_pointloc)
+    # only one part changes per candidate, so its text matrix is the current one with one row substituted
+    sent_feats = encode_part_sentences(clip_model, class_choice, gpt_sents)
+    # the baseline is scored the same way as the candidates, so a candidate only wins by its prompt
+    acc, iou = eval_point_logits(100. * point_feat @ text_feat.half().t(), test_label, class_choice)
+    print('\nBefore prompt search, Acc: {}, IoU: {}.\n'.format(acc, iou))    
     best_acc = acc
     best_iou = iou
     for kk in range(0, 2):
@@ -175,21 +194,49 @@ def search_prompt(class_choice, model_name, prompt_mode="tuned", searched_prompt
                 
                 prompts_temp = prompts.copy()
                 prompts_temp[ii] = gpt_sents[class_choice][cat2part[class_choice][ii]][ss]
-                prompt_token = torch.cat([clip.tokenize(p) for p in prompts_temp]).cuda()
-                text_feat = clip_model.encode_text(prompt_token)
-                text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
+                text_feat_temp = text_feat.clone()
+                text_feat_temp[ii] = sent_feats[ii][ss]
                 
-                acc, iou = run_epoch(vweights, test_feat, test_label, test_ifseen, test_pointloc, text_feat, part_num, class_choice, model_name)
+                point_logits = 100. * point_feat @ text_feat_temp.half().t()
+                acc, iou = eval_point_logits(point_logits, test_label, class_choice)
 
                 if iou > best_iou:
                     print('Acc: {:.2f}, IoU: {:.2f},  obj: {}, part: {}'.format(acc, iou, class_choice, cat2part[class_choice][ii]))
                     best_acc = acc
                     best_iou = iou
                     prompts = prompts_temp
+                    text_feat = text_feat_temp
     print(prompts)
     return prompts
 
 
+@torch.no_grad()
+def check_storage_codecs(class_choice, model_name, prompt_mode="part", searched_prompt=None, feature_path=None):
+    """Segmentation acc and IoU with the features read back after storing them as fp16 and as bf16,
+    against the features as they are stored now. Visibility and point locations are bit-packed
+    and int16 in every case, which is exact.
+    """
+    output_path = feature_path or 'output/{}/{}'.format(model_name.replace('/', '_'), class_choice)
+    _, test_feat, test_label, test_ifseen, test_pointloc = load_features(output_path)
+    test_label = test_label - index_start[cat2id[class_choice]]
+    test_ifseen = round_trip(test_ifseen, 'bits')
+    test_pointloc = round_trip(test_pointloc, 'int16')
+
+    clip_model, _ = clip.load_shared(model_name)
+    clip_model.eval()
+    text_feat, _ = get_shapenetpart_prompt(clip_model, class_choice, prompt_mode, searched_prompt)
+    text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
+    vweights = torch.Tensor(best_vweight[class_choice]).cuda()
+    part_num = text_feat.shape[0]
+
+    base_acc, base_iou = run_epoch(vweights, test_feat.reshape(-1, 10, 196, 512), test_label, test_ifseen, test_pointloc, text_feat, part_num, class_choice, model_name)
+    print('Stored as {}, Acc: {:.2f}, IoU: {:.2f}'.format(test_feat.dtype, base_acc, base_iou))
+    for codec in ['fp16', 'bf16']:
+        feat = round_trip(test_feat, codec).reshape(-1, 10, 196, 512)
+        acc, iou = run_epoch(vweights, feat, test_label, test_ifseen, test_pointloc, text_feat, part_num, class_choice, model_name)
+        print('Stored as {}, Acc: {:.2f} ({:+.2f}), IoU: {:.2f} ({:+.2f})'.format(codec, acc, acc - base_acc, iou, iou - base_iou))
+
+
 @torch.no_grad()
 def search_prompt_partm(class_choice, model_name, test_feat, test_label, test_ifseen, test_pointloc, decorated=True, searched_prompt=None, only_evaluate=True):    
     # output_path = 'output/{}/{}'.format(model_name.replace('/', '_'), class_choice)
@@ -203,7 +250,7 @@ def search_prompt_partm(class_choice, model_name, test_feat, test_label, test_if
     test_feat = test_feat.reshape(-1, 10, 196, 512)
 
     # encoding textual features
-    clip_model, _ = clip.load(model_name)
+    clip_model, _ = clip.load_shared(model_name)
     clip_model.eval()
     text_feat, prompts = get_partnete_generic_prompt(clip_model, class_choice, decorated = decorated)
     text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
@@ -216,8 +263,13 @@ def search_prompt_partm(class_choice, model_name, test_feat, test_label, test_if
         return acc, iou
     
     print("\n***** Searching for prompts *****\n")
-    print('\nBefore prompt search, Acc: {}, IoU: {}.\n'.format(acc, iou))    
     gpt_sents = read_prompts()
+    point_feat = precompute_point_feat(vweights, test_feat, test_ifseen, test_pointloc)
+    # only one part changes per candidate, so its text matrix is the current one with one row substituted
+    sent_feats = encode_part_sentences(clip_model, class_choice, gpt_sents)
+    # the baseline is scored the same way as the candidates, so a candidate only wins by its prompt
+    acc, iou = eval_point_logits(100. * point_feat @ text_feat.half().t(), test_label, class_choice, other=True)
+    print('\nBefore prompt search, Acc: {}, IoU: {}.\n'.format(acc, iou))    
     best_acc = acc
     best_iou = iou
     for kk in range(0, 2):
@@ -226,42 +278,41 @@ def search_prompt_partm(class_choice, model_name, test_feat, test_label, test_if
                 
                 prompts_temp = prompts.copy()
                 prompts_temp[ii] = gpt_sents[class_choice][cat2part[class_choice][ii]][ss]
-                prompt_token = torch.cat([clip.tokenize(p) for p in prompts_temp]).cuda()
-                text_feat = clip_model.encode_text(prompt_token)
-                text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
+                text_feat_temp = text_feat.clone()
+                text_feat_temp[ii] = sent_feats[ii][ss]
                 
-                acc, iou = run_epoch(vweights, test_feat, test_label, test_ifseen, test_pointloc, text_feat, part_num, class_choice, model_name)
+                point_logits = 100. * point_feat @ text_feat_temp.half().t()
+                acc, iou = eval_point_logits(point_logits, test_label, class_choice, other=True)
 
                 if iou > best_iou:
                     print('Acc: {:.2f}, IoU: {:.2f},  obj: {}, part: {}'.format(acc, iou, class_choice, cat2part[class_choice][ii]))
                     best_acc = acc
                     best_iou = iou
                     prompts = prompts_temp
+                    text_feat = text_feat_temp
     print(prompts)
     return prompts
                     
                     
 @torch.no_grad()
-def search_vweight(class_choice, model_name, searched_prompt=None):
+def search_vweight(class_choice, model_name, searched_prompt=None, feature_path=None):
     print("\n***** Searching for view weights *****\n")
     
-    output_path = 'output/{}/{}'.format(model_name.replace('/', '_'), class_choice)
+    output_path = feature_path or 'output/{}/{}'.format(model_name.replace('/', '_'), class_choice)
     
-    test_feat = torch.load(osp.join(output_path, "test_features.pt")).cuda()
-    test_label = torch.load(osp.join(output_path, "test_labels.pt")) - index_start[cat2id[class_choice]]
-    test_ifseen = torch.load(osp.join(output_path, "test_ifseen.pt"))
-    test_pointloc = torch.load(osp.join(output_path, "test_pointloc.pt"))
+    _, test_feat, test_label, test_ifseen, test_pointloc = load_features(output_path)
+    test_label = test_label - index_start[cat2id[class_choice]]
     test_feat = test_feat.reshape(-1, 10, 196, 512)
 
-    clip_model, _ = clip.load(model_name)
+    clip_model, _ = clip.load_shared(model_name)
     clip_model.eval()
-    text_feat, prompts = textual_encoder(clip_model, class_choice, searched_prompt)
+    text_feat, prompts = get_shapenetpart_tuned_prompt(clip_model, class_choice, searched_prompt)
     text_feat = text_feat / text_feat.norm(dim=-1, keepdim=True)
     
     vweights = torch.Tensor(best_vweight[class_choice]).cuda()
-    part_num = text_feat.shape[0]
-    #acc, iou = run_epoch(vweights, test_feat, test_label, test_ifseen, test_pointloc, text_feat, part_num, class_choice, model_name)
-    acc, iou = run_epoch_partnetm(vweights, test_feat, test_label, test_ifseen, test_pointloc, text_feat, part_num, class_choice, model_name)
+    # text is fixed during the search, so only the view weighting of point logits changes
+    point_view_logits = precompute_point_view_logits(test_feat, test_ifseen, test_pointloc, text_feat)
+    acc, iou = eval_point_logits(weight_point_view_logits(point_view_logits, vweights), test_label, class_choice)
     print('\nBefore view weight search, Acc: {}, IoU: {}\n'.format(acc, iou))
     
     best_acc = acc
@@ -274,7 +325,7 @@ def search_vweight(class_choice, model_name, searched_prompt=None):
                     for e in search_list:
                         for f in search_list:                                
                             view_weights = torch.tensor([0.75, 0.75, 0.75, 0.75, a, b, c, d, e, f]).cuda()
-                            acc, iou = run_epoch(view_weights, test_feat, test_label, test_ifseen, test_pointloc, text_feat, part_num, class_choice, model_name)
+                            acc, iou = eval_point_logits(weight_point_view_logits(point_view_logits, view_weights), test_label, class_choice)
 
                             if iou > best_iou:
                                 vweights = [0.75, 0.75, 0.75, 0.75, a, b, c, d, e, f]
@@ -442,6 +493,83 @@ def run_epoch_partnetm(vweights, val_feat, val_label, val_ifseen, val_pointloc,
     return acc, shape_ious * 100.
 
 
+@lru_cache()
+def interp_operator(grid_size, img_size=224, device='cuda'):
+    """Padding, average pooling, bilinear upsampling and gathering in run_epoch
+    are all linear and act on each channel alike. This returns them as a
+    matrix of size [img_size * img_size, grid_size * grid_size], so the value
+    at a pixel is a weighted sum of the feature map patches.
+    """
+    basis = torch.eye(grid_size * grid_size, device=device).reshape(-1, 1, grid_size, grid_size)
+    upsample = torch.nn.Upsample(size=img_size, mode='bilinear')
+    avgpool = torch.nn.AvgPool2d(6,1,0)
+    padding = torch.nn.ReplicationPad2d([2,3,2,3])
+    output = upsample(avgpool(padding(basis)))
+    return output.reshape(grid_size * grid_size, img_size * img_size).t().contiguous()
+
+
+def point_view_feat(feat, is_seen, point_loc, img_size=224):
+    """Back-project feature maps [B, V, HW, C] to each point in each view.
+    Returns:
+        point_feat (torch.tensor): of size [B, V, num_points, C], zero where the point is unseen
+    """
+    b, nv, hw, c = feat.shape
+    op = interp_operator(int(hw**0.5), img_size, str(feat.device))
+    point_loc = point_loc.reshape(b*nv, -1, 2).long().to(feat.device)
+    weight = op[point_loc[:, :, 0] * img_size + point_loc[:, :, 1]]  # [B*V, num_points, HW]
+    point_feat = torch.bmm(weight, feat.reshape(b*nv, hw, c).float())
+    point_feat = point_feat * is_seen.reshape(b*nv, -1, 1).to(point_feat)
+    return point_feat.reshape(b, nv, -1, c)
+
+
+def precompute_point_feat(vweights, val_feat, val_ifseen, val_pointloc, bs=8):
+    """Per-point features [B, num_points, C] with view weights and visibility folded in.
+    Each prompt candidate is then a single matmul with the text features.
+    """
+    point_feat = []
+    for i in range(0, val_feat.shape[0], bs):
+        feat = point_view_feat(val_feat[i:i+bs], val_ifseen[i:i+bs], val_pointloc[i:i+bs])
+        point_feat.append(torch.sum(feat * vweights.view(1, -1, 1, 1), dim=1).half())
+    return torch.cat(point_feat, dim=0)
+
+
+def precompute_point_view_logits(val_feat, val_ifseen, val_pointloc, text_feat, bs=8):
+    """Per-view point logits [B, V, num_points, part_num], zero where the point is unseen.
+    """
+    point_logits = []
+    for i in range(0, val_feat.shape[0], bs):
+        feat = point_view_feat(val_feat[i:i+bs], val_ifseen[i:i+bs], val_pointloc[i:i+bs])
+        point_logits.append((100. * feat.half() @ text_feat.half().t()).float())
+    return torch.cat(point_logits, dim=0)
+
+
+def weight_point_view_logits(point_view_logits, vweights):
+    return torch.sum(point_view_logits * vweights.view(1, -1, 1, 1), dim=1)
+
+
+def eval_point_logits(point_logits, val_label, class_choice, other=False):
+    """Segmentation acc and IoU from point logits [B, num_points, part_num], as in run_epoch.
+    With other=True the last part is "other" and its points are set to -1, as in run_epoch_partnetm.
+    """
+    PC_NUM = point_logits.shape[1]
+    point_seg = torch.topk(point_logits.float(), k=1, dim=-1)[1].squeeze(-1)
+    if other:
+        point_seg[point_seg==point_logits.shape[2]-1] = -1
+    label_seg = val_label.reshape(-1, PC_NUM).to(point_seg.device)
+    class_label = np.array([cat2id[class_choice]] * point_seg.shape[0])
+
+    # calculating segmentation acc
+    ratio = (point_seg == label_seg).float()
+    acc = torch.sum(ratio, dim=-1) / PC_NUM
+    acc = torch.mean(acc) * 100.
+
+    # calculating iou
+    shape_ious, category = calculate_shape_IoU(point_seg.cpu().numpy(), label_seg.cpu().numpy(), class_label, class_choice, eva=True)
+    shape_ious = np.mean(np.array(shape_ious))
+
+    return acc, shape_ious * 100.
+
+
 def eval_sample_objaverse(feat, label, is_seen, point_loc, text_feat, part_num):
     PC_NUM = label.shape[-1]
     feat = feat.reshape(10, 196, 512)
@@ -1,6 +1,7 @@
 import torch.nn as nn
 import numpy as np
 import torch
+from torch.utils.data import Dataset, get_worker_info
 
 TRANS = -1.5
 
@@ -39,11 +40,43 @@ class Grid2Image(nn.Module):
         grid = x / temp_max[:,:,None,None,None]
         grid = 1 - grid
         zz_int = torch.clip(zz_int, 1, params[net]['depth'] - 3)
-        point_depth = torch.zeros_like(nnbatch).cuda()
-        point_depth = grid[nnbatch.long(), torch.Tensor([0]*nnbatch.shape[0]).cuda().long(), zz_int.view(-1,).long(), yy.view(-1,).long(), xx.view(-1,).long()]
+        point_depth = grid[nnbatch.long(), torch.zeros_like(nnbatch).long(), zz_int.view(-1,).long(), yy.view(-1,).long(), xx.view(-1,).long()]
         point_depth = point_depth.view(-1, npts)
         return img, point_depth
 
+class ZBuffer2Image(nn.Module):
+    """2D approximation of Grid2Image on a z-buffer.
+       Maxpool: densifying the z-buffer in x, y
+       Convolution: smoothing via the x, y part of the Gaussian
+       Point depth: in the dense grid, the max-pooled value at a point's own depth slice is
+       the largest depth among its neighbours at most maxpoolz // 2 slices deeper, so it is
+       the smoothed surface capped at the point's slice plus that band. Visibility then
+       follows the same tolerance on the difference to the image as the dense path.
+    """
+    def __init__(self):
+        super().__init__()
+        self.maxpool = nn.MaxPool2d(params[net]['maxpoolxy'], stride=1, padding=params[net]['maxpoolpadxy'])
+        self.conv = torch.nn.Conv2d(1, 1, kernel_size=params[net]['convxy'], stride=1, padding=params[net]['convpadxy'], bias=False)
+        kn2d = getGaussianKernel2D(params[net]['convxy'], sigma=params[net]['convsigmaxy'])
+        self.conv.weight.data = torch.Tensor(kn2d)[None, None, :, :]
+        self.band = params[net]['maxpoolz'] // 2
+
+    def forward(self, x, nnbatch, zz_int, yy, xx):
+        npts = yy.shape[-1]
+        surface = self.maxpool(x.unsqueeze(1))
+        x = self.conv(surface)
+
+        temp_max = torch.max(torch.max(x, dim=-1)[0], dim=-1)[0]
+        img = x / temp_max[:,:,None,None]
+        img = 1 - img
+
+        zz_int = torch.clip(zz_int, 1, params[net]['depth'] - 3)
+        nnbatch, yy, xx = nnbatch.long(), yy.view(-1,).long(), xx.view(-1,).long()
+        point_depth = torch.minimum(x[nnbatch, 0, yy, xx], zz_int.view(-1,) + self.band) / temp_max[nnbatch, 0]
+        point_depth = 1 - point_depth.view(-1, npts)
+        return img.repeat(1,3,1,1), point_depth
+
+
 def euler2mat(angle):
     """Convert euler angles to rotation matrix.
      :param angle: [3] or [b, 3]
@@ -93,9 +126,7 @@ def euler2mat(angle):
     return rot_mat
 
 
-def points2grid(points, image_height, image_width, depth=params[net]['depth'], device='cpu'):
-    batch, pnum, _ = points.shape
-
+def quantize_points(points, image_height, image_width, depth=params[net]['depth']):
     pmax, pmin = points.max(dim=1)[0], points.min(dim=1)[0]
     pcent = (pmax + pmin) / 2
     pcent = pcent[:, None, :]
@@ -116,6 +147,12 @@ def points2grid(points, image_height, image_width, depth=params[net]['depth'], d
     _x = torch.clip(_x, 1, params[net]['resolution'] - 2)
     _y = torch.clip(_y, 1, params[net]['resolution'] - 2)
     _z = torch.clip(_z, 1, depth - 2) 
+    return _x, _y, z_int, _z
+
+
+def points2grid(points, image_height, image_width, depth=params[net]['depth'], device='cpu'):
+    batch, pnum, _ = points.shape
+    _x, _y, z_int, _z = quantize_points(points, image_height, image_width, depth)
 
     # nbatch: [0,0,0...0,0,0, 1,1,1...1,1,1, 2,2,2,...2,2,2, ... 14,14,14, 15,15,15]
     nbatch = torch.repeat_interleave(torch.arange(0, batch)[:,None],pnum).view(-1, ).to(device)
@@ -128,10 +165,35 @@ def points2grid(points, image_height, image_width, depth=params[net]['depth'], d
     return grid.squeeze(), _x, _y, z_int, _z, nbatch
 
 
+def points2zbuffer(points, image_height, image_width, depth=params[net]['depth'], device='cpu'):
+    """Z-buffer counterpart of points2grid. Instead of a dense 3D grid, only the
+    largest depth value of each pixel is kept, which is the value that survives
+    the max over depth in Grid2Image.
+    Returns:
+        zbuffer (torch.tensor): of size [B * self.num_views, resolution, resolution], laid out as the permuted grid
+    """
+    batch, pnum, _ = points.shape
+    _x, _y, z_int, _z = quantize_points(points, image_height, image_width, depth)
+
+    nbatch = torch.repeat_interleave(torch.arange(0, batch)[:,None],pnum).view(-1, ).to(device)
+    pixel = (_x.long() * image_width + _y.long()).view(batch, -1)
+    zbuffer = torch.full([batch, image_height * image_width], params[net]['bg_clr'], device=points.device)
+    zbuffer = zbuffer.scatter_reduce(1, pixel, _z.view(batch, -1), reduce='amax', include_self=True)
+    return zbuffer.view(batch, image_height, image_width), _x, _y, z_int, _z, nbatch
+
+
 class Realistic_Projection:
     """For creating images from PC based on the view information.
     """
-    def __init__(self, gpu='cuda:0'):
+    def __init__(self, device='cuda:0' if torch.cuda.is_available() else 'cpu', renderer='dense', check_tol=None, num_threads=0, views=None):
+        """
+        Args:
+            device (str or torch.device): where the projection runs
+            num_threads (int): number of intra-op threads on CPU, 0 keeps the torch default
+            renderer (str): 'dense' renders through the full 3D grid, 'zbuffer' through a 2D depth buffer
+            check_tol (float): if set, the z-buffer output is compared with the dense one on every call
+            views (list): optional view stages replacing the default ones, see ViewBank
+        """
         _views = np.asarray([
             [[0 * np.pi / 2, 0, np.pi / 2], [-0.5, -0.5, TRANS]],
             [[1 * np.pi / 2, 0, np.pi / 2], [-0.5, -0.5, TRANS]],
@@ -171,20 +233,18 @@ class Realistic_Projection:
             [[0, np.pi / 15, 0], [-0.5, 0, TRANS]],
             ])
 
-        self.num_views = 10
-        self.device = torch.device(gpu)
-
-        angle = torch.tensor(_views[:, 0, :]).float().to(self.device)
-        self.rot_mat = euler2mat(angle).transpose(1, 2)
-        angle2 = torch.tensor(_views2[:, 0, :]).float().to(self.device)
-        self.rot_mat2 = euler2mat(angle2).transpose(1, 2)
-        angle3 = torch.tensor(_views3[:, 0, :]).float().to(self.device)
-        self.rot_mat3 = euler2mat(angle3).transpose(1, 2)
-
-        self.translation = torch.tensor(_views[:, 1, :]).float().to(self.device)
-        self.translation = self.translation.unsqueeze(1)
+        if not views:
+            views = [_views, _views2, _views3]
+        self.view_bank = ViewBank(*views)
+        self.num_views = self.view_bank.num_views
+        self.device = torch.device(device)
+        if self.device.type == 'cpu' and num_threads > 0:
+            torch.set_num_threads(num_threads)
 
+        self.renderer = renderer
+        self.check_tol = check_tol
         self.grid2image = Grid2Image().to(self.device)
+        self.zbuffer2image = ZBuffer2Image().to(self.device)
 
     def get_img(self, points):
         """Get images from point cloud.
@@ -195,22 +255,41 @@ class Realistic_Projection:
             is_seen (torch.tensor, bool): of size [B * self.num_views, num_points, 1], if the point can be seen in each view
             point_loc_in_img (torch.tensor): of size [B * self.num_views, num_points, 2], point location in each view
         """
-        b, _, _ = points.shape
-        v = self.translation.shape[0]
-
-        self._points = self.point_transform(
-            points=torch.repeat_interleave(points, v, dim=0),
-            rot_mat=self.rot_mat.repeat(b, 1, 1),
-            rot_mat2=self.rot_mat2.repeat(b, 1, 1),
-            rot_mat3=self.rot_mat3.repeat(b, 1, 1),
-            translation=self.translation.repeat(b, 1, 1))
-            
-        grid, xx, yy, zz_int, zz, nnbatch = points2grid(points=self._points, image_height=params[net]['resolution'], image_width=params[net]['resolution'], device=self.device)        
-        img, pc_depth = self.grid2image(grid, nnbatch, zz_int, yy, xx)
+        points = points.to(self.device)
+        self._points = self.view_bank(points)
+
+        img, is_seen, point_loc_in_img = self.render(self.renderer)
+        if self.renderer == 'zbuffer' and self.check_tol is not None:
+            self.check_equivalence(img, is_seen)
+        return img, is_seen, point_loc_in_img
+
+    def render(self, renderer):
+        if renderer == 'dense':
+            grid, xx, yy, zz_int, zz, nnbatch = points2grid(points=self._points, image_height=params[net]['resolution'], image_width=params[net]['resolution'], device=self.device)        
+            img, pc_depth = self.grid2image(grid, nnbatch, zz_int, yy, xx)
+        elif renderer == 'zbuffer':
+            zbuffer, xx, yy, zz_int, zz, nnbatch = points2zbuffer(points=self._points, image_height=params[net]['resolution'], image_width=params[net]['resolution'], device=self.device)
+            img, pc_depth = self.zbuffer2image(zbuffer, nnbatch, zz_int, yy, xx)
+        else:
+            raise Exception("unknown renderer!")
 
         is_seen, point_loc_in_img = self.tell_seen_unseen(img, pc_depth, nnbatch, zz_int, xx, yy)
         return img, is_seen, point_loc_in_img
 
+    def check_equivalence(self, img, is_seen):
+        """Compare the z-buffer output with the dense one on the current points, raising if
+        either differs by more than check_tol.
+        Returns:
+            img_diff (float): mean absolute difference of the images
+            seen_diff (float): fraction of points whose visibility differs
+        """
+        img_dense, is_seen_dense, _ = self.render('dense')
+        img_diff = torch.mean(torch.abs(img - img_dense)).item()
+        seen_diff = torch.mean((is_seen != is_seen_dense).float()).item()
+        if img_diff > self.check_tol or seen_diff > self.check_tol:
+            raise Exception('z-buffer rendering differs from the dense one, img: {:.4f}, is_seen: {:.4f}, tolerance: {}!'.format(img_diff, seen_diff, self.check_tol))
+        return img_diff, seen_diff
+
     def tell_seen_unseen(self, img, pc_depth, nnbatch, zz_int, xx, yy):
         """To determine whether each point can be seen in each view angle, and its location.
         Args:
@@ -219,37 +298,64 @@ class Realistic_Projection:
             is_seen (torch.tensor, bool): of size [B * self.num_views, num_points, 1], if the point can be seen in each view
             point_loc_in_img (torch.tensor): of size [B * self.num_views, num_points, 2], point location in each view
         """
-        batch, pnum = self._points.shape[0], self._points.shape[1]
+        pnum = self._points.shape[1]
 
         zz_int = torch.clip(zz_int, 1, params[net]['depth'] - 3)
         
-        pc_depth_from_img = img[nnbatch.long(), torch.Tensor([0]*(pnum*batch)).view(-1,).long(), yy.view(-1,).long(), xx.view(-1,).long()]
+        pc_depth_from_img = img[nnbatch.long(), torch.zeros_like(nnbatch).long(), yy.view(-1,).long(), xx.view(-1,).long()]
         pc_depth_from_img = pc_depth_from_img.view(-1, pnum)
 
-        unseen_mark = torch.zeros_like(pc_depth_from_img)
-        seen_mark = torch.ones_like(pc_depth_from_img)
-
-        is_seen = torch.where(torch.abs(pc_depth_from_img - pc_depth) < 0.1, seen_mark, unseen_mark)
+        # 0/1 in uint8 rather than float, a quarter of the memory and it multiplies logits just the same
+        is_seen = (torch.abs(pc_depth_from_img - pc_depth) < 0.1).to(torch.uint8)
 
         point_loc_in_img = torch.cat([yy.view(-1,)[:,None], xx.view(-1,)[:,None]], dim=1).view(-1, pnum, 2)
         return is_seen, point_loc_in_img
 
-    @staticmethod
-    def point_transform(points, rot_mat, rot_mat2, rot_mat3, translation):
+
+class ViewBank:
+    """Fused rigid transforms of all views. Each view is a chain of rotations
+    followed by a translation, folded once into a single 3x4 matrix [R; -t]
+    and cached per (device, dtype).
+    """
+    def __init__(self, views, *views_bias):
+        """
+        Args:
+            views (array): of size [V, 2, 3], euler angles and translation of each view
+            views_bias (array): of size [V, 2, 3], euler angles applied after the view rotation, translations are ignored
         """
-        :param points: [batch, num_points, 3]
-        :param rot_mat: [batch, 3]
-        :param translation: [batch, 1, 3]
-        :return:
+        views = np.asarray(views, dtype=np.float64)
+        self.num_views = views.shape[0]
+
+        rot_mat = euler2mat(torch.tensor(views[:, 0, :])).transpose(1, 2)
+        for bias in views_bias:
+            bias = np.asarray(bias, dtype=np.float64)
+            assert bias.shape[0] == self.num_views, 'every view stage needs one entry per view'
+            rot_mat = rot_mat @ euler2mat(torch.tensor(bias[:, 0, :])).transpose(1, 2)
+        translation = torch.tensor(views[:, 1, :])
+
+        # [V, 4, 3]: points @ transform[:, :3] + transform[:, 3]
+        self.transform = torch.cat([rot_mat, -translation[:, None, :]], dim=1)
+        self._cache = {}
+
+    def get(self, device, dtype=torch.float32):
+        key = (torch.device(device), dtype)
+        if key not in self._cache:
+            self._cache[key] = self.transform.to(device=key[0], dtype=dtype)
+        return self._cache[key]
+
+    def __call__(self, points):
+        """
+        Args:
+            points (torch.tensor): of size [B, num_points, 3]
+        Returns:
+            points (torch.tensor): of size [B * num_views, num_points, 3], view-major within each batch item
         """
-        rot_mat = rot_mat.to(points.device)
-        rot_mat2 = rot_mat2.to(points.device)
-        translation = translation.to(points.device)
-        points = torch.matmul(points, rot_mat)
-        points = torch.matmul(points, rot_mat2)
-        points = torch.matmul(points, rot_mat3)
-        points = points - translation
-        return points
+        b, n, _ = points.shape
+        transform = self.get(points.device, points.dtype)
+        points = torch.einsum('bnk,vkj->bvnj', points, transform[:, :3]) + transform[None, :, None, 3]
+        # einsum may keep a [b, n, v, 3] memory layout, which a batch of one would only view
+        return points.contiguous().reshape(b * self.num_views, n, 3)
+
 
 def getGaussianKernel2D(ksize, sigma=0):
     center = ksize // 2
@@ -266,7 +372,38 @@ def getGaussianKernel3D(ksize, depth, sigma=2, zsigma=2):
     k3d = np.repeat(k2d[None,:,:], depth, axis=0) * zkernel[:,None, None]
     k3d = k3d / np.sum(k3d)
     k3d = k3d[None, None, :, :, :]
-    return k3d 
- 
+    return k3d
+
 
-    
\ No newline at end of file
+def mv_proj(pc_views, pc):
+    """Project point clouds and crop the images to the object, as fed to CLIP."""
+    img, is_seen, point_loc_in_img = pc_views.get_img(pc)
+    img = img[:, :, 20:204, 20:204]
+    point_loc_in_img = torch.ceil((point_loc_in_img - 20) * 224. / 184.)
+    img = torch.nn.functional.interpolate(img, size=(224, 224), mode='bilinear', align_corners=True)
+    return img, is_seen, point_loc_in_img
+
+
+class MultiViewDataset(Dataset):
+    """Wraps a dataset whose items start with a point cloud, and appends its
+    projection (img, is_seen, point_loc_in_img) computed in the DataLoader
+    worker processes on CPU.
+    """
+    def __init__(self, dataset, renderer='dense', views=None):
+        self.dataset = dataset
+        self.renderer = renderer
+        self.views = views
+        self.pc_views = None
+
+    def __getitem__(self, item):
+        if self.pc_views is None:
+            # created lazily, once per worker process
+            num_threads = 1 if get_worker_info() is not None else 0
+            self.pc_views = Realistic_Projection(device='cpu', renderer=self.renderer, num_threads=num_threads, views=self.views)
+        data = self.dataset[item]
+        with torch.no_grad():
+            img, is_seen, point_loc_in_img = mv_proj(self.pc_views, torch.as_tensor(data[0]).float()[None])
+        return (*data, img, is_seen, point_loc_in_img)
+
+    def __len__(self):
+        return len(self.dataset)
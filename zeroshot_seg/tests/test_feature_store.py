@@ -0,0 +1,34 @@
+import os
+import os.path as osp
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from feature_store import FeatureShardWriter, FeatureShards, compact_codecs, is_complete, shard_file
+
+
+def write_objects(writer, num):
+    for i in range(writer.num_written, num):
+        writer.append(features=torch.full((2, 3), float(i)), ifseen=torch.ones(2, 9), pointloc=torch.full((2, 2), float(i)))
+    writer.close()
+
+
+def test_resume_with_missing_shard(tmp_path):
+    path = str(tmp_path)
+    write_objects(FeatureShardWriter(path, shard_size=4, codecs=compact_codecs()), 10)
+    assert is_complete(path)
+
+    os.remove(shard_file(path, 'test', 'features', 1))
+    assert not is_complete(path)
+    with pytest.raises(Exception, match='missing'):
+        FeatureShards(path)
+
+    writer = FeatureShardWriter(path, shard_size=4, codecs=compact_codecs())
+    assert writer.num_written == 4
+    write_objects(writer, 10)
+    assert is_complete(path)
+    features = FeatureShards(path).load('features')
+    assert torch.equal(features[:, 0, 0].float(), torch.arange(10).float())
@@ -0,0 +1,48 @@
+import os.path as osp
+import sys
+
+import torch
+
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from realistic_projection import Realistic_Projection, params, net, points2grid
+
+
+def test_view_bank_batch_one():
+    torch.manual_seed(0)
+    pc_views = Realistic_Projection(device='cpu')
+    view_bank = pc_views.view_bank
+    pc = torch.rand(1, 2048, 3)
+
+    points = view_bank(pc)
+    assert points.is_contiguous()
+    transform = view_bank.get('cpu')
+    for v in range(view_bank.num_views):
+        assert torch.allclose(points[v], pc[0] @ transform[v, :3] + transform[v, 3], atol=1e-6)
+
+    resolution = params[net]['resolution']
+    grid, _, _, _, _, _ = points2grid(points, resolution, resolution)
+    assert grid.shape == (view_bank.num_views, params[net]['depth'], resolution, resolution)
+
+
+def sphere(n=2048):
+    points = torch.randn(1, n, 3)
+    return points / points.norm(dim=-1, keepdim=True)
+
+
+def box(n=2048):
+    points = torch.rand(1, n, 3) * 2 - 1
+    axis = torch.randint(0, 3, (n,))
+    points[0, torch.arange(n), axis] = torch.sign(torch.randn(n))
+    return points * torch.tensor([1.0, 0.6, 0.3])
+
+
+def test_zbuffer_visibility_matches_dense():
+    torch.manual_seed(0)
+    for pc in [sphere(), box()]:
+        pc_views = Realistic_Projection(device='cpu', renderer='zbuffer', check_tol=1.)
+        with torch.no_grad():
+            img, is_seen, _ = pc_views.get_img(pc)
+            img_dense, is_seen_dense, _ = pc_views.render('dense')
+        seen_diff = torch.mean((is_seen != is_seen_dense).float()).item()
+        assert seen_diff < 0.05, seen_diff